@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""Benchmark collect/cleanup against synthetic sheets, without Google Sheets.
+
+Usage: python3 benchmark.py [--output=dir|zip|tar|db] [ROWS ...]   (default: dir, 1000 10000 100000)
+
+Each sheet has repeated resubmissions (many rows per student and problem) and
+large code cells. For both commands it times a full run followed by an
+incremental run after 1% more rows are appended, split into fetch, timestamp
+parsing, filtering and grouping, file writes and write-back, the middle two from
+the run's own phase metrics.
+"""
+
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+import main
+
+HEADER = ["Dấu thời gian", "Số báo danh", "Ngôn ngữ", "Mã bài", "Code"]
+USERS = 200
+PROBLEMS = 8
+CODE_SIZE = 4000  # characters per code cell
+
+def make_rows(count, start, rng):
+    """Submissions one second apart; about a third are sent with the password instead of the username"""
+    rows = []
+    for n in range(start, start + count):
+        user = rng.randrange(USERS)
+        sbd = f"pw{user}" if rng.random() < 0.3 else f"user{user}"
+        lang = rng.choice(["C++", "Python"])
+        body = f"// submission {n}\n" + "x = 1\n" * (CODE_SIZE // 6)
+        timestamp = datetime.datetime(2025, 1, 1) + datetime.timedelta(seconds=n)
+        rows.append([timestamp.strftime("%d/%m/%Y %H:%M:%S"), sbd, lang, f"P{rng.randrange(PROBLEMS)}", body])
+    return rows
+
+class Timer:
+    """Accumulates the time spent inside wrapped functions"""
+
+    def __init__(self):
+        self.total = 0.0
+
+    def wrap(self, func):
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.total += time.perf_counter() - started
+        return timed
+
+def bench(row_count, command, workdir, output="dir"):
+    rng = random.Random(row_count)
+    sheet_path = os.path.join(workdir, f"sheet-{row_count}.json")
+    rows = [HEADER] + make_rows(row_count, 0, rng)
+    with open(sheet_path, "w", encoding="utf-8") as f:
+        json.dump(rows, f)
+
+    # persist=False keeps write-back in memory so it measures the client side, not JSON dumps
+    backend = main.FileBackend(sheet_path, persist=False)
+    spreadsheet = backend.open_spreadsheet(None)
+    worksheet = spreadsheet.worksheet(None)
+    fetch, writes, write_back = Timer(), Timer(), Timer()
+    worksheet.batch_get = fetch.wrap(worksheet.batch_get)
+    worksheet.update_cells = write_back.wrap(worksheet.update_cells)
+
+    target = os.path.join(workdir, f"out-{command}-{row_count}" + ("" if output == "dir" else f".{output}"))
+    sink = main.open_sink(target)
+    sink.write = writes.wrap(sink.write)
+    sink.flush = writes.wrap(sink.flush)
+
+    contest = main.Contest(sheet_path, "bench", command=command, contest_id="bench",
+                           users_file=os.path.join(workdir, "users.txt"), output_dir=target)
+    results = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for mode in ("full", "incremental"):
+            fetch.total = writes.total = write_back.total = 0.0
+            started = time.perf_counter()
+            if mode == "full":
+                contest.open(backend)
+            else:
+                worksheet.rows.extend(make_rows(max(1, row_count // 100), row_count, rng))
+                contest.refresh_rows()
+            fetched = time.perf_counter()
+            # The run's own phase metrics split the scan into timestamp parsing and grouping
+            phases = contest.metrics.phases
+            parse_before, group_before = phases.get("parse", 0.0), phases.get("group", 0.0)
+            contest.run(incremental=(mode == "incremental"))
+            finished = time.perf_counter()
+
+            results.append((mode, fetched - started, phases.get("parse", 0.0) - parse_before,
+                            phases.get("group", 0.0) - group_before,
+                            writes.total, write_back.total, finished - started))
+    return results
+
+def main_benchmark(argv):
+    output = "dir"
+    sizes = []
+    for arg in argv[1:]:
+        if arg.startswith("--output="):
+            output = arg.split("=", 1)[1]
+        else:
+            sizes.append(int(arg))
+    sizes = sizes or [1000, 10000, 100000]
+    with tempfile.TemporaryDirectory() as workdir:
+        with open(os.path.join(workdir, "users.txt"), "w", encoding="utf-8") as f:
+            for user in range(USERS):
+                f.write(f"user{user}:pw{user}\n")
+
+        print(f"{'rows':>8} {'command':<8} {'mode':<12} {'fetch':>8} {'parse':>8} {'group':>8} {'files':>8} {'write':>8} {'total':>8}")
+        for row_count in sizes:
+            for command in ("collect", "cleanup"):
+                for mode, *timings in bench(row_count, command, workdir, output):
+                    print(f"{row_count:>8} {command:<8} {mode:<12} " + " ".join(f"{t:>7.3f}s" for t in timings))
+
+if __name__ == "__main__":
+    main_benchmark(sys.argv)
@@ -1,18 +1,31 @@
 #!/usr/bin/env python3
 
-import gspread
-from google.oauth2.service_account import Credentials
 import os
 import re
-from dotenv import load_dotenv
 import random
+import contextlib
+import csv
 import datetime
+import hashlib
+import heapq
+import hmac
+import io
+import itertools
+import json
+import sqlite3
+import stat
+import tempfile
+import threading
 import time
 import sys
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import parse_qs, urlsplit
 
-load_dotenv()
-SPREADSHEET_URL = os.getenv("SPREADSHEET_URL")
-SHEETNAME = os.getenv("SHEETNAME")
+# gspread, google-auth and dotenv are imported where they are used, so that importing this
+# module and usage errors don't pay for them, and --dry-run never needs gspread or google-auth.
+# The same goes for the modules only some options need: the webhook listener, --profile,
+# archive outputs and --precheck import theirs on first use.
 
 
 def parse_time_interval(time_str):
@@ -20,16 +33,16 @@ def parse_time_interval(time_str):
     time_str = time_str.strip().lower()
     if not time_str:
         return 5  # default 5 seconds
-    
+
     # Extract number and unit
     match = re.match(r'^(\d+\.?\d*)([smh]?)$', time_str)
     if not match:
         print(f"ERROR: Invalid time format '{time_str}'. Use formats like: 5s, 5m, 1h")
         sys.exit(1)
-    
+
     value = float(match.group(1))
     unit = match.group(2) or 's'  # default to seconds if no unit
-    
+
     if unit == 's':
         return int(value)
     elif unit == 'm':
@@ -37,505 +50,3072 @@ def parse_time_interval(time_str):
     elif unit == 'h':
         return int(value * 3600)
 
-# Usage: python3 main.py <collect|cleanup> [--first|--last] [--row=N] [--watch[=interval]] [--contest-id=ID]
-if len(sys.argv) < 2 or sys.argv[1] not in ["collect", "cleanup"]:
-    print("Usage: python3 main.py <collect|cleanup> [--first|--last] [--row=N] [--watch[=interval]] [--contest-id=ID]")
+def format_interval(seconds):
+    """Format an interval in seconds for display (e.g. 300 -> '5m')"""
+    if seconds < 60:
+        return f"{seconds}s"
+    elif seconds < 3600:
+        return f"{seconds // 60}m"
+    return f"{seconds // 3600}h"
+
+def print_usage():
+    print("Usage: python3 main.py <collect|cleanup> [--first|--last] [--row=N] [--watch[=interval]] [--contest-id=ID] [--projected] [--state=FILE] [--fresh] [--config=FILE] [--sheet-file=FILE] [--record=FILE] [--replay=FILE] [--stream[=N]] [--shards=N] [--listen=[HOST:]PORT] [--adaptive[=max]] [--read-quota=N] [--write-quota=N] [--output=DIR|FILE] [--ledger[=FILE]] [--flush-ledger] [--metrics=FILE] [--quiet] [--profile[=DIR]] [--profile-every=N] [--dry-run] [--precheck[=FILE]]")
     print("  --watch interval can be: 5s, 5m, 1h (default: 5s)")
     print("  --contest-id: Custom contest ID (default: random number)")
-    sys.exit(1)
-
-command = sys.argv[1]
-sub_order = "last"  # default
-start_row = 2  # default (skip header at row 1)
-watch_mode = False  # default
-watch_interval = 5  # default 5 seconds
-contest_id = None  # default None (will generate random)
-
-# Parse optional arguments
-i = 2
-while i < len(sys.argv):
-    arg = sys.argv[i]
-    
-    if arg == "--first":
-        sub_order = "first"
-    elif arg == "--last":
-        sub_order = "last"
-    elif arg == "--watch":
-        watch_mode = True
-        # Check if next arg is a time interval (not starting with --)
-        if i + 1 < len(sys.argv) and not sys.argv[i + 1].startswith("--"):
-            watch_interval = parse_time_interval(sys.argv[i + 1])
-            i += 1  # skip the interval arg
-        else:
-            watch_interval = 5  # default
-    elif arg.startswith("--watch="):
-        watch_mode = True
-        interval_str = arg.split("=", 1)[1]
-        watch_interval = parse_time_interval(interval_str)
-    elif arg.startswith("--row="):
+    print("  --projected: Fetch metadata columns first, then code only for winning submissions")
+    print("  --state=FILE: Watch state database used to resume after a restart (default: watch_state.db)")
+    print("  --fresh: Ignore saved watch state and start with a full scan")
+    print("  --config=FILE: JSON file listing many contests to serve from one process")
+    print("  --sheet-file=FILE: Read a local CSV/JSON file instead of the Google Sheet (offline runs and benchmarks)")
+    print("  --record=FILE: Record every sheet read and write to FILE")
+    print("  --replay=FILE: Replay a recording instead of contacting Google Sheets")
+    print(f"  --stream[=N]: Process the sheet in pages of N rows (default: {STREAM_PAGE_ROWS}) to bound memory on huge sheets")
+    print("  --shards=N: Fetch large ranges as N row shards in parallel (default: 1)")
+    print("  --listen=[HOST:]PORT: With --watch, poll as soon as a webhook POST arrives (e.g. from a form-submit trigger)")
+    print("  --adaptive[=max]: With --watch, poll every watch interval while submissions arrive and back off up to max when idle (default: 10m)")
+    print("  --output=DIR|FILE: Where collected files go: a directory (default: BaiLam), a .zip/.tar/.tar.gz archive or a .db SQLite store")
+    print("  --ledger[=FILE]: Record processed rows in a local SQLite ledger (default: ledger.db) instead of rewriting timestamps in the sheet")
+    print("  --flush-ledger: After the run, write the ledger's timestamps back to the sheet in one batch (end of contest)")
+    print(f"  --read-quota=N, --write-quota=N: Sheets requests per minute to stay within (default: {READ_QUOTA_PER_MINUTE} each)")
+    print("  --metrics=FILE: Append per-iteration phase timings and counters as JSON lines, or keep a Prometheus text file if FILE ends in .prom (repeatable)")
+    print("  --quiet: Only print warnings, errors and one 📈 summary line per iteration")
+    print("  --profile[=DIR]: Write a cProfile dump and a top-allocations summary per iteration to DIR (default: profiles)")
+    print("  --profile-every=N: With --profile, only profile iteration 1 and every Nth one after it")
+    print("  --precheck[=FILE]: Syntax-check collected files on all cores and record the results in a manifest (default: precheck.json)")
+    print("  --dry-run: Check the options, config, users files and credentials without contacting Google, then exit")
+
+# Header patterns of the columns we read, compiled once; the first matching column wins
+HEADER_PATTERNS = {
+    "timestamp": re.compile(r"\b(dấu thời gian|timestamp)\b", re.IGNORECASE),
+    "sbd": re.compile(r"\b(số báo danh|sbd|mã nộp bài)\b", re.IGNORECASE),
+    "lang": re.compile(r"\b(ngôn ngữ|ext\w*)\b", re.IGNORECASE),
+    "mabai": re.compile(r"mã bài", re.IGNORECASE),
+    "code": re.compile(r"\bcode\b", re.IGNORECASE),
+}
+
+# Column mapping per header row, shared by contests on the same form: header tuple -> {field: index}
+header_columns = {}
+
+def map_header(header):
+    """Column index of every field in HEADER_PATTERNS, cached by header"""
+    key = tuple(header)
+    columns = header_columns.get(key)
+    if columns is None:
+        columns = {}
+        for field, pattern in HEADER_PATTERNS.items():
+            columns[field] = next((i for i, col in enumerate(header) if pattern.search(col)), None)
+            if columns[field] is None:
+                raise ValueError(f"No column matching pattern '{pattern.pattern}' found.")
+        header_columns[key] = columns
+    return columns
+
+def col_letter(idx):
+    """Convert a 0-based column index to its A1 letter (0 -> A, 26 -> AA)"""
+    letters = ""
+    idx += 1
+    while idx:
+        idx, rem = divmod(idx - 1, 26)
+        letters = chr(ord("A") + rem) + letters
+    return letters
+
+# Timestamp formats Google Forms may produce, in the order they are tried.
+# Slash dates follow the sheet's locale: the first one with a part above 12
+# settles day-first or month-first for the whole sheet. Until then they are
+# read day-first, same as trying "%d/%m/%Y" before "%m/%d/%Y" with strptime.
+TIMESTAMP_FORMATS = ["%d/%m/%Y %H:%M:%S", "%m/%d/%Y %H:%M:%S", "%Y-%m-%d %H:%M:%S", "%d-%m-%Y %H:%M:%S"]
+TIMESTAMP_PATTERNS = [
+    ("dmy_or_mdy", re.compile(r"(\d{1,2})/(\d{1,2})/(\d{4}) (\d{1,2}):(\d{1,2}):(\d{1,2})")),
+    ("ymd", re.compile(r"(\d{4})-(\d{1,2})-(\d{1,2}) (\d{1,2}):(\d{1,2}):(\d{1,2})")),
+    ("dmy_dash", re.compile(r"(\d{1,2})-(\d{1,2})-(\d{4}) (\d{1,2}):(\d{1,2}):(\d{1,2})")),
+]
+TIMESTAMP_CACHE_LIMIT = 200000
+
+class TimestampParser:
+    """Parses one sheet's timestamp cells, detecting the sheet's format on first use"""
+
+    def __init__(self):
+        self.cache = {}  # timestamp string -> Unix timestamp, or None if unparseable
+        self.pattern_order = list(range(len(TIMESTAMP_PATTERNS)))  # detected sheet format first
+        self.slash_order = None  # "dmy" or "mdy" once a slash date has settled it
+        self.ambiguous_parsed = 0  # slash dates read day-first before the order was settled
+        self.misread = 0  # of those, how many turned out to be month-first
+        self.hour_starts = {}  # (year, month, day, hour) -> Unix time of that local hour, None if invalid
+        self.prefix_starts = {}  # cell text up to the hour ("13/01/2025 10") -> Unix time of that hour
+
+    def settle(self, a, b):
+        """Fix the slash date order from a date whose first (a) or second (b) part is above 12"""
+        if a > 12:
+            self.slash_order = "dmy"
+        elif b > 12:
+            self.slash_order = "mdy"
+            if self.ambiguous_parsed:
+                # Ambiguous dates were read day-first; forget them so they are parsed again
+                self.misread = self.ambiguous_parsed
+                self.cache.clear()
+                self.prefix_starts.clear()
+        return self.slash_order is not None
+
+    def detect(self, cells):
+        """Settle the slash date order from cells before parsing them, so every row is read the same way"""
+        if self.slash_order is not None:
+            return
+        pattern = TIMESTAMP_PATTERNS[0][1]
+        for cell in cells:
+            match = pattern.fullmatch(cell) if isinstance(cell, str) else None
+            if match and self.settle(int(match.group(1)), int(match.group(2))):
+                return
+
+    def hour_start(self, year, month, day, hour):
+        # mktime is the slow part, and DST only ever shifts at hour boundaries
+        key = (year, month, day, hour)
         try:
-            start_row = int(arg.split("=")[1])
-            if start_row < 2:
-                print("ERROR: --row must be >= 2 (row 1 is the header)")
-                sys.exit(1)
-        except (ValueError, IndexError):
-            print("ERROR: Invalid --row format. Use --row=N where N is a number >= 2")
-            sys.exit(1)
-    elif arg.startswith("--contest-id="):
-        contest_id = arg.split("=", 1)[1].strip()
-        if not contest_id:
-            print("ERROR: --contest-id cannot be empty")
-            sys.exit(1)
-    else:
-        print("Unknown option: {}".format(arg))
-        print("Usage: python3 main.py <collect|cleanup> [--first|--last] [--row=N] [--watch[=interval]] [--contest-id=ID]")
-        print("  --watch interval can be: 5s, 5m, 1h (default: 5s)")
-        print("  --contest-id: Custom contest ID (default: random number)")
-        sys.exit(1)
-    
-    i += 1
-
-if not SHEETNAME:
-    raise ValueError("Missing SHEETNAME in environment variables")
-
-if not SPREADSHEET_URL:
-    raise ValueError("Missing SPREADSHEET_URL in environment variables")
-
-SCOPES = ["https://www.googleapis.com/auth/spreadsheets"]
-creds = Credentials.from_service_account_file("service_account.json", scopes=SCOPES)
-client = gspread.authorize(creds)
-
-try:
-    sheet = client.open_by_url(SPREADSHEET_URL).worksheet(SHEETNAME)
-except Exception as e:
-    raise ValueError(f"Cannot open spreadsheet: {e}, maybe the sheet name is wrong?")
-
-# Function to find column index using regex
-def find_col_index(header, pattern):
-    for i, col in enumerate(header):
-        if re.search(pattern, col, re.IGNORECASE):
-            return i
-    raise ValueError(f"No column matching pattern '{pattern}' found.")
-
-# Efficient data fetching using batch_get
-def get_sheet_data(start_row_num=1, end_row_num=None):
-    """Fetch sheet data efficiently using batch_get"""
-    # Don't include sheet name in range - worksheet.batch_get() already operates on this sheet
-    if end_row_num is None:
-        range_str = f"A{start_row_num}:Z"
-    else:
-        range_str = f"A{start_row_num}:Z{end_row_num}"
-    
+            return self.hour_starts[key]
+        except KeyError:
+            pass
+        try:
+            value = int(time.mktime(datetime.datetime(year, month, day, hour).timetuple()))
+        except ValueError:
+            value = None
+        self.hour_starts[key] = value
+        return value
+
+    def _parse_uncached(self, timestamp_str):
+        # Cells rewritten to a Unix integer are already collected
+        if timestamp_str.isdigit():
+            return None
+
+        # Rows of the same hour only differ in ":MM:SS"; reuse the hour parsed for an earlier row
+        two_digit_tail = len(timestamp_str) > 6 and timestamp_str[-3] == ":" and timestamp_str[-6] == ":"
+        if two_digit_tail:
+            start = self.prefix_starts.get(timestamp_str[:-6])
+            minute, second = timestamp_str[-5:-3], timestamp_str[-2:]
+            if start is not None and minute.isdecimal() and second.isdecimal():
+                minute, second = int(minute), int(second)
+                return start + minute * 60 + second if minute <= 59 and second <= 59 else None
+
+        for position, pattern_idx in enumerate(self.pattern_order):
+            kind, pattern = TIMESTAMP_PATTERNS[pattern_idx]
+            match = pattern.fullmatch(timestamp_str)
+            if not match:
+                continue
+            a, b, c, hour, minute, second = map(int, match.groups())
+            if position:
+                # Remember the sheet's format so the next row hits it first
+                self.pattern_order.insert(0, self.pattern_order.pop(position))
+            if minute > 59 or second > 59:
+                return None
+            if kind == "dmy_or_mdy":
+                if self.slash_order is None and not self.settle(a, b):
+                    self.ambiguous_parsed += 1
+                day, month = (b, a) if self.slash_order == "mdy" else (a, b)
+                start = self.hour_start(c, month, day, hour)
+                if start is None:
+                    # A date the sheet's order can't hold; read it the other way like strptime would
+                    start = self.hour_start(c, day, month, hour)
+            elif kind == "ymd":
+                start = self.hour_start(a, b, c, hour)
+            else:
+                start = self.hour_start(c, b, a, hour)
+            if start is None:
+                return None
+            if two_digit_tail:
+                self.prefix_starts[timestamp_str[:-6]] = start
+            return start + minute * 60 + second
+
+        # Anything the fast path does not recognise goes through strptime as before
+        for date_format in TIMESTAMP_FORMATS:
+            try:
+                dt = datetime.datetime.strptime(timestamp_str, date_format)
+                return int(time.mktime(dt.timetuple()))
+            except ValueError:
+                continue
+        return None
+
+    def parse(self, timestamp_str):
+        """Parse a sheet timestamp cell to a Unix timestamp.
+
+        Returns None for unparseable cells and for cells already marked as
+        collected (a Unix integer). Results are memoized per string.
+        """
+        unix_timestamp = self.cache.get(timestamp_str, self)  # self marks a miss, None is a cached result
+        if unix_timestamp is not self:
+            return unix_timestamp
+        if len(self.cache) >= TIMESTAMP_CACHE_LIMIT:
+            self.cache.clear()
+        unix_timestamp = self.cache[timestamp_str] = self._parse_uncached(timestamp_str)
+        return unix_timestamp
+
+# Rows per page fetched in streaming mode (--stream)
+STREAM_PAGE_ROWS = 2000
+
+# Sharded fetch (--shards): smallest shard worth its own request, and retries per shard
+SHARD_MIN_ROWS = 500
+SHARD_MAX_RETRIES = 4
+MAX_SHARDS = 16  # keeps one refresh well inside the read quota (60 requests per minute per user)
+
+# Adaptive polling (--adaptive): idle polls stretch the interval by this factor, up to the
+# maximum; every interval is jittered by +/-10% so contests don't poll in lockstep
+ADAPTIVE_BACKOFF = 1.5
+ADAPTIVE_MAX_INTERVAL = 600
+ADAPTIVE_JITTER = 0.1
+# Failed polls back off exponentially from the watch interval, up to this many seconds
+ERROR_BACKOFF_MAX = 300
+
+# Webhook triggers arriving within this many seconds are handled by one poll
+WEBHOOK_DEBOUNCE = 0.5
+
+# Profiling (--profile): stack depth recorded per allocation, and lines in each summary
+PROFILE_TRACE_FRAMES = 10
+PROFILE_TOP = 25
+
+# Pre-checking (--precheck): compiler command for C++ syntax checks, seconds and bytes of
+# address space per file (POSIX), and characters of compiler output kept per file in the manifest
+PRECHECK_CXX = ["g++", "-std=c++17", "-fsyntax-only", "-x", "c++", "-"]
+PRECHECK_TIMEOUT = 30
+PRECHECK_MEMORY = 1 << 30
+PRECHECK_MESSAGE_CHARS = 2000
+
+# Rows per block when comparing cached rows against the sheet's fingerprint columns
+FINGERPRINT_BLOCK_ROWS = 200
+DRIVE_FILES_URL = "https://www.googleapis.com/drive/v3/files/{}"
+
+SERVICE_ACCOUNT_FILE = "service_account.json"
+
+# Google Sheets allows 60 read and 60 write requests per minute per user
+READ_QUOTA_PER_MINUTE = 60
+WRITE_QUOTA_PER_MINUTE = 60
+WRITE_CHUNK_SIZE = 500  # cells per update_cells request
+WRITE_MAX_RETRIES = 6
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+# A cell update for update_cells; gspread only reads row, col and value, like the offline backends
+Cell = namedtuple("Cell", ["row", "col", "value"])
+
+class TokenBucket:
+    """Token bucket refilled continuously up to a per-minute request budget"""
+
+    def __init__(self, per_minute, kind="Write"):
+        self.kind = kind
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def acquire(self):
+        """Take one token; returns the seconds the caller has to wait before using it (0 if none)"""
+        with self.lock:
+            self._refill()
+            self.tokens -= 1
+            # A negative balance is a reservation: wait until it has been refilled
+            return -self.tokens / self.rate if self.tokens < 0 else 0
+
+    def drain(self):
+        """Empty the bucket after the server reports the quota is exhausted"""
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0.0)
+
+def error_status(error):
+    """HTTP status code of a gspread API error, or None for other errors"""
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None)
+
+def retry_delay(error, attempt):
+    """Seconds to wait before a retry: Retry-After if the server sent one, else exponential backoff with jitter"""
+    response = getattr(error, "response", None)
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    if retry_after:
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+    return min(64, 2 ** attempt) + random.uniform(0, 1)
+
+# mkstemp creates files as 0600; replacements get the mode open() would have used instead
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+def replacement_mode(filepath):
+    """Permissions for a file replacing filepath: those of the current file, else 0666 minus the umask"""
+    try:
+        return stat.S_IMODE(os.stat(filepath).st_mode)
+    except FileNotFoundError:
+        return 0o666 & ~UMASK
+
+def write_file_atomic(filepath, content, written_hashes):
+    """Write content through a temp file + rename so readers never see a partial file.
+
+    written_hashes caches the sha256 of each file already written or checked.
+    Returns False without touching the disk when the file already holds the same content.
+    """
+    digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    if filepath not in written_hashes and os.path.exists(filepath):
+        with open(filepath, "r", encoding="utf-8", errors="replace") as f:
+            written_hashes[filepath] = hashlib.sha256(f.read().encode("utf-8")).hexdigest()
+    if written_hashes.get(filepath) == digest:
+        return False
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filepath) or ".", prefix=".", suffix=".part")
     try:
-        data = sheet.batch_get([range_str])
-        if data and len(data) > 0:
-            return data[0]
-        return []
-    except Exception as e:
-        print(f"⚠️ Error fetching data: {e}")
-        # Exponential backoff on error
-        time.sleep(random.uniform(1, 3))
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.chmod(tmp_path, replacement_mode(filepath))
+        os.replace(tmp_path, filepath)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
         raise
+    written_hashes[filepath] = digest
+    return True
 
-# Initial data load
-rows = get_sheet_data()
-print(f"Sheet has {len(rows)} total rows (including header)")
-
-header = rows[0]
-idx_timestamp = find_col_index(header, r"\b(dấu thời gian|timestamp)\b")
-idx_sbd = find_col_index(header, r"\b(số báo danh|sbd|mã nộp bài)\b")
-idx_lang = find_col_index(header, r"\b(ngôn ngữ|ext\w*)\b")
-idx_mabai = find_col_index(header, r"mã bài")
-idx_code = find_col_index(header, r"\bcode\b")
-
-print(f"Column indices: timestamp={idx_timestamp}, sbd={idx_sbd}, lang={idx_lang}, mabai={idx_mabai}, code={idx_code}")
-
-# Track last checked timestamp for incremental processing
-last_checked_timestamp = 0
-
-# Set file_id once (either custom contest_id or random)
-file_id = contest_id if contest_id else random.randint(1, int(1e9))
-if contest_id:
-    print(f"Using contest ID: {file_id}")
-else:
-    print(f"Using random ID: {file_id}")
-
-# Read users.txt file and load it into a dict
-# Also create reverse mapping: password -> username
-users = {}  # username -> password
-password_to_username = {}  # password -> username (for mapping)
-if os.path.exists("users.txt"):
-    with open("users.txt", "r", encoding="utf-8") as f:
+def load_users(users_file):
+    """Read a users file (username:password per line).
+
+    Returns (users, password_to_username). Raises ValueError if the file is
+    missing or two users share a password.
+    """
+    users = {}  # username -> password
+    password_to_username = {}  # password -> username (for mapping)
+    if not os.path.exists(users_file):
+        raise ValueError(f"No {users_file} file found, cannot map submissions to users.")
+
+    with open(users_file, "r", encoding="utf-8") as f:
         for line in f:
             if line.strip():
                 username, password = line.strip().split(":", 1)
                 users[username] = password
-                
+
                 # Check for duplicate passwords
                 if password in password_to_username:
-                    print(f"❌ ERROR: Duplicate password '{password}' found for users '{password_to_username[password]}' and '{username}'")
-                    print("Please ensure each user has a unique password in users.txt")
-                    exit(1)
-                
+                    raise ValueError(
+                        f"Duplicate password '{password}' found for users '{password_to_username[password]}' and '{username}' "
+                        f"in {users_file}. Please ensure each user has a unique password."
+                    )
+
                 password_to_username[password] = username
+    return users, password_to_username
 
-    print(f"Loaded {len(users)} users with unique passwords")
-else:
-    print("No users.txt file found, proceeding without user authentication.")
-    exit(1)
+class Roster:
+    """The users file as username and password indexes, reloaded when the file changes.
 
-def run_collect(incremental=False):
-    """Execute the collect command
-    
-    Args:
-        incremental: If True, only process rows with timestamp > last_checked_timestamp
+    reload() only rereads the file when its mtime or size changed, and then
+    patches the indexes with the entries that were added, changed or removed,
+    so the dicts handed out stay the same objects.
     """
-    global last_checked_timestamp, file_id
 
-    # Clear old folder before collect subs
-    # if os.path.exists("BaiLam"):
-    #     import shutil
-    #     shutil.rmtree("BaiLam")
-    # os.makedirs("BaiLam", exist_ok=True)
+    def __init__(self, users_file):
+        self.users_file = users_file
+        self.signature = None  # (mtime_ns, size) of the file last loaded
+        self.users = {}  # username -> password
+        self.password_to_username = {}  # password -> username (for mapping)
 
-    # For collect: process ALL submissions, not just unique combinations
-    if incremental:
-        print(f"Reading from row {start_row} to end (incremental mode: timestamp > {last_checked_timestamp})...")
-    else:
-        print(f"Reading from row {start_row} to end...")
-    
-    # First pass: collect all valid submissions with timestamps
-    submissions = []
-    current_max_timestamp = last_checked_timestamp
-    
-    for row_num, row in enumerate(rows[start_row-1:], start=start_row):
-        # Skip empty rows or rows that are too short
-        if not row or len(row) <= max(idx_timestamp, idx_sbd, idx_lang, idx_mabai, idx_code):
-            continue
-        
+    def reload(self):
+        """Reload the file if it changed. Returns the usernames and passwords that were added or changed"""
         try:
-            sbd = row[idx_sbd].strip() if idx_sbd < len(row) else ""
-            timestamp_str = row[idx_timestamp].strip() if idx_timestamp < len(row) else ""
-            
-            # Skip if essential fields are empty
-            if not sbd or not timestamp_str:
-                continue
-                
-            # Try multiple date formats
-            dt = None
-            for date_format in ["%d/%m/%Y %H:%M:%S", "%m/%d/%Y %H:%M:%S", "%Y-%m-%d %H:%M:%S", "%d-%m-%Y %H:%M:%S"]:
-                try:
-                    dt = datetime.datetime.strptime(timestamp_str, date_format)
-                    break
-                except ValueError:
-                    continue
-            
-            if dt is None:
-                continue
-            
-            # Convert to UNIX timestamp for comparison
-            unix_timestamp = int(time.mktime(dt.timetuple()))
-            
-            # Skip if incremental mode and timestamp is not newer
-            if incremental and unix_timestamp <= last_checked_timestamp:
-                continue
-            
-            # Track the maximum timestamp seen
-            current_max_timestamp = max(current_max_timestamp, unix_timestamp)
-            
-        except (ValueError, IndexError):
-            continue
-        
-        # Map password to username if the SBD is a password
-        actual_username = sbd
-        if sbd in password_to_username:
-            actual_username = password_to_username[sbd]
-        elif sbd not in users:
-            continue
-        
-        mabai = row[idx_mabai].strip() if idx_mabai < len(row) else ""
-        lang = row[idx_lang].strip() if idx_lang < len(row) else ""
-        code = row[idx_code].strip() if idx_code < len(row) else ""
-        
-        # Make mabai uppercase
-        mabai = mabai.upper()
-        
-        # Prevent some stupid errors.
-        if not sbd or not lang or not mabai or not code:
+            stat = os.stat(self.users_file)
+        except FileNotFoundError:
+            raise ValueError(f"No {self.users_file} file found, cannot map submissions to users.")
+        signature = [stat.st_mtime_ns, stat.st_size]
+        if signature == self.signature:
+            return set()
+
+        users, _ = load_users(self.users_file)
+
+        # Drop removed or changed entries first so a password can move between users
+        for username, password in list(self.users.items()):
+            if users.get(username) != password:
+                del self.users[username]
+                del self.password_to_username[password]
+        added = set()
+        for username, password in users.items():
+            if username not in self.users:
+                self.users[username] = password
+                self.password_to_username[password] = username
+                added.update((username, password))
+
+        self.signature = signature
+        return added
+
+class Ledger:
+    """Rows already processed, kept in a local SQLite file instead of rewriting their timestamp cells.
+
+    Each row is recorded with a hash of its metadata cells, so a row number
+    that now holds a different submission (rows deleted above it) is not
+    mistaken for a processed one. Entries stay pending until they are written
+    back to the sheet with --flush-ledger.
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = key  # spreadsheet|sheet|command
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS ledger (
+                ledger_key TEXT NOT NULL,
+                row_num INTEGER NOT NULL,
+                row_hash TEXT NOT NULL,
+                unix_timestamp INTEGER NOT NULL,
+                flushed INTEGER NOT NULL DEFAULT 0,
+                recorded_at REAL NOT NULL,
+                PRIMARY KEY (ledger_key, row_num)
+            );
+        """)
+        self.conn.commit()
+        self.row_hashes = dict(self.conn.execute(
+            "SELECT row_num, row_hash FROM ledger WHERE ledger_key = ?", (key,)
+        ))  # row_num -> row_hash
+
+    def contains(self, row_num, row_hash):
+        return self.row_hashes.get(row_num) == row_hash
+
+    def record(self, entries):
+        """Record (row_num, row_hash, unix_timestamp) entries in one transaction"""
+        now = time.time()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO ledger (ledger_key, row_num, row_hash, unix_timestamp, flushed, recorded_at) "
+                "VALUES (?, ?, ?, ?, 0, ?)",
+                [(self.key, row_num, row_hash, unix_timestamp, now) for row_num, row_hash, unix_timestamp in entries],
+            )
+        for row_num, row_hash, _ in entries:
+            self.row_hashes[row_num] = row_hash
+
+    def pending(self):
+        """(row_num, row_hash, unix_timestamp) of entries not yet written back to the sheet"""
+        return self.conn.execute(
+            "SELECT row_num, row_hash, unix_timestamp FROM ledger WHERE ledger_key = ? AND flushed = 0 ORDER BY row_num",
+            (self.key,),
+        ).fetchall()
+
+    def mark_flushed(self, row_nums):
+        with self.conn:
+            self.conn.executemany(
+                "UPDATE ledger SET flushed = 1 WHERE ledger_key = ? AND row_num = ?", [(self.key, r) for r in row_nums]
+            )
+
+class Metrics:
+    """Phase durations (seconds) and counters of one watch iteration or run.
+
+    Phases are wall-clock sections; "fetch" and "update_cells" add up the time
+    spent in Sheets API calls and so overlap the phases they happen in.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.phases = {}
+        self.counters = {}
+        self.lock = threading.Lock()  # sharded fetches count from worker threads
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - started)
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        phases = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in self.phases.items())
+        counters = ", ".join(f"{n} {name.replace('_', ' ')}" for name, n in self.counters.items())
+        return f"{time.time() - self.started_at:.2f}s ({phases}); {counters}"
+
+class MetricsExporter:
+    """Writes each finished Metrics to JSON lines files and/or Prometheus text files (*.prom)"""
+
+    def __init__(self, targets):
+        self.targets = targets
+        self.lock = threading.Lock()
+        self.latest = {}  # contest -> (iteration, Metrics) of its last iteration
+        self.totals = {}  # contest -> {counter: total since start}
+
+    def export(self, contest, iteration, metrics):
+        with self.lock:
+            totals = self.totals.setdefault(contest, {"iterations": 0})
+            totals["iterations"] += 1
+            for name, n in metrics.counters.items():
+                totals[name] = totals.get(name, 0) + n
+            self.latest[contest] = (iteration, metrics)
+
+            for target in self.targets:
+                if target.endswith(".prom"):
+                    # node_exporter's textfile collector reads the file whole, so replace it atomically
+                    write_file_atomic(target, self.prometheus_text(), {})
+                else:
+                    record = {
+                        "time": metrics.started_at,
+                        "contest": contest,
+                        "iteration": iteration,
+                        "duration": round(time.time() - metrics.started_at, 6),
+                        "phases": {name: round(seconds, 6) for name, seconds in metrics.phases.items()},
+                        "counters": metrics.counters,
+                    }
+                    with open(target, "a", encoding="utf-8") as f:
+                        f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def prometheus_text(self):
+        lines = [
+            "# HELP cpfetch_phase_seconds Time spent in each phase of the last iteration.",
+            "# TYPE cpfetch_phase_seconds gauge",
+        ]
+        for contest, (_, metrics) in sorted(self.latest.items()):
+            for name, seconds in sorted(metrics.phases.items()):
+                lines.append(f'cpfetch_phase_seconds{{contest="{contest}",phase="{name}"}} {seconds:.6f}')
+        lines += [
+            "# HELP cpfetch_last_iteration_timestamp_seconds When the last iteration started.",
+            "# TYPE cpfetch_last_iteration_timestamp_seconds gauge",
+        ]
+        for contest, (_, metrics) in sorted(self.latest.items()):
+            lines.append(f'cpfetch_last_iteration_timestamp_seconds{{contest="{contest}"}} {metrics.started_at:.3f}')
+        names = sorted({name for totals in self.totals.values() for name in totals})
+        for name in names:
+            lines.append(f"# TYPE cpfetch_{name}_total counter")
+            for contest, totals in sorted(self.totals.items()):
+                lines.append(f'cpfetch_{name}_total{{contest="{contest}"}} {totals.get(name, 0)}')
+        return "\n".join(lines) + "\n"
+
+class Profiler:
+    """Writes a cProfile dump and a top-allocations summary for profiled iterations (--profile)"""
+
+    def __init__(self, directory, every=1):
+        self.directory = directory
+        self.every = every  # profile iteration 1 and then every Nth one
+        # cProfile can only profile one thread at a time; contests polled meanwhile are not profiled
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def wants(self, iteration):
+        return (iteration - 1) % self.every == 0
+
+    @contextlib.contextmanager
+    def profile(self, name):
+        """Profile the block; the files are DIRECTORY/NAME.prof and DIRECTORY/NAME.txt"""
+        if not self.lock.acquire(blocking=False):
+            yield
+            return
+        import cProfile
+        import tracemalloc
+        # Tracing only runs during sampled iterations, the others don't pay for it
+        started = not tracemalloc.is_tracing()
+        try:
+            if started:
+                tracemalloc.start(PROFILE_TRACE_FRAMES)
+            tracemalloc.reset_peak()
+            before = tracemalloc.take_snapshot()
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                yield
+            finally:
+                profile.disable()
+                _, peak = tracemalloc.get_traced_memory()
+                after = tracemalloc.take_snapshot()
+                if started:
+                    tracemalloc.stop()
+                self.dump(name, profile, before, after, peak)
+        finally:
+            self.lock.release()
+
+    def dump(self, name, profile, before, after, peak):
+        import cProfile
+        import pstats
+        import tracemalloc
+        path = os.path.join(self.directory, name)
+        profile.dump_stats(path + ".prof")
+        with open(path + ".txt", "w", encoding="utf-8") as f:
+            f.write("Allocations are traced process-wide: with several contests (--config), the memory\n"
+                    "figures include whatever other contests' polls allocated during this iteration.\n\n")
+            f.write(f"Peak traced memory: {peak / 1e6:.1f} MB\n\n")
+            f.write(f"Top {PROFILE_TOP} allocations still held after the iteration:\n")
+            # Leave out the profiler's own bookkeeping
+            ignore = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, cProfile.__file__)]
+            for stat in after.filter_traces(ignore).compare_to(before.filter_traces(ignore), "lineno")[:PROFILE_TOP]:
+                f.write(f"  {stat}\n")
+            f.write(f"\nTop {PROFILE_TOP} functions by cumulative time:\n")
+            pstats.Stats(profile, stream=f).sort_stats("cumulative").print_stats(PROFILE_TOP)
+
+# Pre-checking runs in worker processes, so these are plain module-level functions
+CPP_HINTS = re.compile(r"#\s*include\b|\bint\s+main\s*\(|\bstd::|\bcout\b|\bcin\s*>>|\busing\s+namespace\b")
+PY_HINTS = re.compile(r"^\s*(def|import|from)\s|\bprint\s*\(|\binput\s*\(", re.MULTILINE)
+
+def detect_language(code):
+    """"cpp" or "py" when the code clearly looks like one of them, else None"""
+    cpp, py = bool(CPP_HINTS.search(code)), bool(PY_HINTS.search(code))
+    if cpp != py:
+        return "cpp" if cpp else "py"
+    return None
+
+# A preprocessor directive, allowing comments between "#" (or its digraph "%:") and the name
+CPP_DIRECTIVE = re.compile(r"\s*(?:#|%:)\s*(?:/\*.*?\*/\s*)*(\w*)\s*(?:/\*.*?\*/\s*)*(.*)")
+CPP_HEADER = re.compile(r'(?:<([^<>"]*)>|"([^"]*)")')
+
+def unsafe_include(code):
+    """The first #include the compiler must not follow, or None.
+
+    Submissions are untrusted: an include of an absolute path, a parent
+    directory or a macro could read any file the collector can, and put it in
+    the compiler's messages. Relative includes are safe because the compiler
+    runs in an empty directory, where they fall back to the standard headers.
+    """
+    for line in code.replace("\\\r\n", "").replace("\\\n", "").splitlines():
+        match = CPP_DIRECTIVE.match(line)
+        if not match:
             continue
-        
-        if "c" in lang.lower():
-            ext = "cpp"
-        elif "py" in lang.lower():
-            ext = "py"
-        else:
+        name, rest = match.groups()
+        if not name and "/*" in rest:
+            return line.strip()  # a comment hiding the directive name on the next lines
+        if name not in ("include", "include_next", "import", "embed"):
             continue
-        
-        submissions.append((dt, row_num, sbd, actual_username, mabai, ext, code))
-    
-    # Sort submissions by timestamp (ascending = oldest first, descending = newest first)
-    if sub_order == "first":
-        submissions.sort(key=lambda x: x[0])  # Oldest first, so first occurrences are processed first
+        header = CPP_HEADER.match(rest)
+        path = header and (header.group(1) if header.group(1) is not None else header.group(2))
+        if not path or path.startswith(("/", "\\")) or ":" in path or ".." in re.split(r"[/\\]", path):
+            return line.strip()
+    return None
+
+def limit_precheck_memory():
+    """Cap the compiler's address space, so that a submission can't exhaust the machine's memory"""
+    import resource
+    resource.setrlimit(resource.RLIMIT_AS, (PRECHECK_MEMORY, PRECHECK_MEMORY))
+
+def check_syntax(code, ext):
+    """(ok, message) for a syntax check of code as C++ or Python; ok is None if it could not be checked"""
+    if ext == "py":
+        try:
+            compile(code, "<submission>", "exec")
+        except (SyntaxError, ValueError) as e:
+            return False, f"line {getattr(e, 'lineno', '?')}: {getattr(e, 'msg', e)}"
+        return True, ""
+    import subprocess
+    include = unsafe_include(code)
+    if include is not None:
+        return None, f"not checked, includes a file outside the standard headers: {include[:200]}"
+    try:
+        # An empty working directory keeps relative includes away from .env and service_account.json
+        with tempfile.TemporaryDirectory(prefix="precheck-") as workdir:
+            result = subprocess.run(PRECHECK_CXX, input=code, capture_output=True, text=True, timeout=PRECHECK_TIMEOUT,
+                                    cwd=workdir, preexec_fn=limit_precheck_memory if os.name == "posix" else None)
+    except FileNotFoundError:
+        return None, f"{PRECHECK_CXX[0]} not found"
+    except subprocess.TimeoutExpired:
+        return None, f"{PRECHECK_CXX[0]} timed out after {PRECHECK_TIMEOUT}s"
+    # Keep only diagnostics about the submission itself, never lines quoting other files
+    message = "\n".join(line for line in result.stderr.splitlines() if line.startswith("<stdin>:"))
+    return result.returncode == 0, message[:PRECHECK_MESSAGE_CHARS]
+
+def precheck_submission(code, ext):
+    """Syntax-check a submission saved with extension ext, trying the other language if it looks mislabelled"""
+    ok, message = check_syntax(code, ext)
+    language = ext
+    detected = detect_language(code)
+    other = "py" if ext == "cpp" else "cpp"
+    if (ok is not True or detected == other) and detected != ext:
+        if check_syntax(code, other)[0]:
+            language, ok, message = other, True, ""
+    if ok is None:
+        status = "unchecked"
+    elif not ok:
+        status = "error"
     else:
-        submissions.sort(key=lambda x: x[0])  # Same order, but later ones will overwrite
-    
-    print(f"Found {len(submissions)} valid submissions to process (order: {sub_order})")
-    
-    # Second pass: process submissions in sorted order
-    processed_count = 0
-    skipped_count = len(rows) - start_row + 1 - len(submissions)
-    os.makedirs("BaiLam", exist_ok=True)
-    
-    # Batch updates for Google Sheets
-    batch_updates = []
-    
-    for dt, row_num, sbd, actual_username, mabai, ext, code in submissions:
-        filename = f"[{file_id}][{actual_username}][{mabai}].{ext}"
-        filepath = os.path.join("BaiLam", filename)
-        
-        if sub_order == "first":
-            # For --first: keep the first submission, skip if file exists
-            if os.path.exists(filepath):
-                print(f"⚠️  File {filepath} already exists (keeping first submission), skipping...")
-                batch_updates.append((row_num, idx_timestamp + 1, int(time.mktime(dt.timetuple()))))
-                continue
-        # For --last: always overwrite to keep the latest submission
-        
-        with open(filepath, "w", encoding="utf-8") as f:
-            f.write(code)
-        print(f"✅ Saved {filepath}")
-        batch_updates.append((row_num, idx_timestamp + 1, int(time.mktime(dt.timetuple()))))
-        processed_count += 1
-    
-    # Batch update all timestamps at once using a single API call
-    if batch_updates:
-        print(f"Updating {len(batch_updates)} timestamps in Google Sheets (single API call)...")
+        status = "ok" if language == ext else "wrong_language"
+    return {"language": language, "status": status, "message": message}
+
+class Prechecker:
+    """Syntax-checks collected submissions on a process pool and keeps the results in a JSON manifest (--precheck).
+
+    The manifest maps each file to the sha256 of its content, the language it
+    was saved as ("declared"), the language it compiles as and a status: ok,
+    error, wrong_language or unchecked (no compiler). Results are reused for
+    content that was checked before, so unchanged resubmissions cost nothing.
+    """
+
+    def __init__(self, manifest_file, workers=None):
+        self.manifest_file = manifest_file
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = None  # started on first use
+        self.lock = threading.Lock()
         try:
-            # Use gspread.Cell for efficient batch updates in one request
-            cells = [gspread.Cell(r, c, v) for (r, c, v) in batch_updates]
-            sheet.update_cells(cells, value_input_option="USER_ENTERED")
-            print("✅ All timestamps updated in one batch")
-        except Exception as e:
-            print(f"⚠️ Error updating timestamps: {e}")
-            # Exponential backoff on error
-            time.sleep(random.uniform(1, 3))
-            raise
-    
-    # Update last checked timestamp for incremental mode
-    if current_max_timestamp > last_checked_timestamp:
-        last_checked_timestamp = current_max_timestamp
-        print(f"📊 Updated last checked timestamp to: {last_checked_timestamp}")
-    
-    print(f"✅ Collect complete. Processed {processed_count} submissions, skipped {skipped_count} rows.")
-
-def run_cleanup(incremental=False):
-    """Execute the cleanup command
-    
-    Args:
-        incremental: If True, only process rows with timestamp > last_checked_timestamp
+            with open(manifest_file, "r", encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+        except ValueError as e:
+            raise ValueError(f"{manifest_file} is not a precheck manifest: {e}")
+        self.results = {f"{entry['declared']}:{entry['sha256']}": entry for entry in self.manifest.values()}
+
+    def check(self, submissions):
+        """Check (name, code, ext) submissions, update the manifest, and return (entries, number newly checked)"""
+        with self.lock:
+            if self.pool is None:
+                from concurrent.futures import ProcessPoolExecutor
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            pending = {}
+            keys = []
+            for name, code, ext in submissions:
+                digest = hashlib.sha256(code.encode("utf-8")).hexdigest()
+                key = f"{ext}:{digest}"
+                if key not in self.results and key not in pending:
+                    pending[key] = (digest, ext, self.pool.submit(precheck_submission, code, ext))
+                keys.append((name, key))
+
+        # Wait outside the lock so contests polled meanwhile can queue their own files
+        for key, (digest, ext, future) in pending.items():
+            self.results[key] = dict(sha256=digest, declared=ext, **future.result())
+
+        with self.lock:
+            entries = []
+            for name, key in keys:
+                self.manifest[name] = self.results[key]
+                entries.append((name, self.results[key]))
+            write_file_atomic(self.manifest_file, json.dumps(self.manifest, ensure_ascii=False, indent=1, sort_keys=True), {})
+        return entries, len(pending)
+
+    def close(self):
+        """Shut the worker processes down; left running, they break interpreter shutdown"""
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=True)
+                self.pool = None
+
+def close_prechecks(contests):
+    for prechecker in {contest.prechecker for contest in contests} - {None}:
+        prechecker.close()
+
+# Output sinks: where collected submissions are written. A sink has
+# exists(name), write(name, content) returning False when the stored content
+# is already the same, flush() to make the writes of one run durable, close()
+# when the collector stops, and describe(name) for the log. Contests sharing
+# a target share one sink.
+
+class DirectorySink:
+    """One file per submission in a directory (BaiLam/), each written atomically"""
+
+    def __init__(self, path):
+        self.path = path
+        self.written_hashes = {}  # filepath -> sha256 of what is on disk
+        self.lock = threading.Lock()
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.path, name))
+
+    def write(self, name, content):
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            return write_file_atomic(os.path.join(self.path, name), content, self.written_hashes)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def describe(self, name):
+        return os.path.join(self.path, name)
+
+class ArchiveSink:
+    """All submissions in one .zip, .tar or .tar.gz archive.
+
+    Only the sha256 of each entry is kept in memory. A .zip or .tar grows by
+    appending the files saved since the last flush, so a poll writes only its
+    new files; a resubmission is appended again and the later entry wins on
+    extraction. A .tar.gz can't be appended to and is rewritten on every flush,
+    streaming the old entries through a temp file + rename. close() rewrites an
+    archive with replaced entries once, keeping only the latest of each.
     """
-    global last_checked_timestamp
-    
-    # Group submissions by (actual_username, mabai) for cleanup
-    subs = {}
-    row_map = {}
-    
-    if incremental:
-        print(f"Reading from row {start_row} to end (incremental mode: timestamp > {last_checked_timestamp})...")
-    else:
-        print(f"Reading from row {start_row} to end...")
-    
-    processed_count = 0
-    skipped_count = 0
-    current_max_timestamp = last_checked_timestamp
-    
-    for row_num, row in enumerate(rows[start_row-1:], start=start_row):
-        # Skip empty rows or rows that are too short
-        if not row or len(row) <= max(idx_timestamp, idx_sbd, idx_lang, idx_mabai, idx_code):
-            skipped_count += 1
-            continue
-        
+
+    def __init__(self, path):
+        self.path = path
+        lower = path.lower()
+        self.appendable = not lower.endswith((".tar.gz", ".tgz"))
+        self.hashes = {}  # name -> sha256 of its latest entry
+        self.pending = {}  # name -> encoded content saved since the last flush
+        self.replaced = False  # the archive holds entries that later ones replace
+        self.lock = threading.Lock()
+        for name, data in self.entries():
+            self.replaced = self.replaced or name in self.hashes
+            self.hashes[name] = hashlib.sha256(data).hexdigest()
+
+    def is_zip(self):
+        return self.path.lower().endswith(".zip")
+
+    def entries(self):
+        """(name, bytes) of each file in the archive on disk, in archive order, one at a time"""
+        if not os.path.exists(self.path):
+            return
+        import tarfile
+        import zipfile
+        if self.is_zip():
+            with zipfile.ZipFile(self.path) as archive:
+                for info in archive.infolist():
+                    if not info.is_dir():
+                        yield info.filename, archive.read(info)
+        else:
+            with tarfile.open(self.path) as archive:
+                for member in archive:
+                    if member.isfile():
+                        yield member.name, archive.extractfile(member).read()
+
+    def exists(self, name):
+        return name in self.hashes
+
+    def write(self, name, content):
+        data = content.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if self.hashes.get(name) == digest:
+                return False
+            if name in self.hashes and name not in self.pending:
+                self.replaced = True
+            self.hashes[name] = digest
+            self.pending[name] = data
+            return True
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            if not self.appendable:
+                self.rewrite()
+            elif self.is_zip():
+                import warnings
+                import zipfile
+                with warnings.catch_warnings():
+                    # Resubmissions are appended under the same name on purpose
+                    warnings.filterwarnings("ignore", "Duplicate name", UserWarning)
+                    with zipfile.ZipFile(self.path, "a", zipfile.ZIP_DEFLATED) as archive:
+                        for name, data in self.pending.items():
+                            archive.writestr(name, data)
+            else:
+                import tarfile
+                with tarfile.open(self.path, "a") as archive:
+                    self.add_members(archive, self.pending.items())
+            self.pending.clear()
+
+    def close(self):
+        """Drop replaced entries by rewriting the archive once, when the collector stops"""
+        with self.lock:
+            if self.replaced:
+                self.rewrite()
+
+    def add_members(self, archive, items):
+        import tarfile
+        now = time.time()
+        for name, data in items:
+            info = tarfile.TarInfo(name)
+            info.size, info.mtime = len(data), now
+            archive.addfile(info, io.BytesIO(data))
+
+    def latest_entries(self):
+        """The entries a rewrite keeps: the one holding each name's latest content, then the pending files"""
+        kept = set(self.pending)
+        for name, data in self.entries():
+            if name not in kept and hashlib.sha256(data).hexdigest() == self.hashes[name]:
+                kept.add(name)
+                yield name, data
+        yield from self.pending.items()
+
+    def rewrite(self):
+        """Write the latest entry of every file (pending ones included) to a new archive that replaces the old one"""
+        import tarfile
+        import zipfile
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(self.path) or ".", prefix=".", suffix=".part")
         try:
-            sbd = row[idx_sbd].strip() if idx_sbd < len(row) else ""
-            timestamp_str = row[idx_timestamp].strip() if idx_timestamp < len(row) else ""
-            
-            # Skip if essential fields are empty
-            if not sbd or not timestamp_str:
-                skipped_count += 1
-                continue
-                
-            # Try multiple date formats
-            dt = None
-            for date_format in ["%d/%m/%Y %H:%M:%S", "%m/%d/%Y %H:%M:%S", "%Y-%m-%d %H:%M:%S", "%d-%m-%Y %H:%M:%S"]:
-                try:
-                    dt = datetime.datetime.strptime(timestamp_str, date_format)
-                    break
-                except ValueError:
+            with os.fdopen(fd, "wb") as f:
+                if self.is_zip():
+                    with zipfile.ZipFile(f, "w", zipfile.ZIP_DEFLATED) as archive:
+                        for name, data in self.latest_entries():
+                            archive.writestr(name, data)
+                else:
+                    with tarfile.open(fileobj=f, mode="w" if self.appendable else "w:gz") as archive:
+                        self.add_members(archive, self.latest_entries())
+            os.chmod(tmp_path, replacement_mode(self.path))
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.pending.clear()
+        self.replaced = False
+
+    def describe(self, name):
+        return f"{self.path}:{name}"
+
+class SqliteSink:
+    """Submissions in a SQLite database, with identical sources stored once.
+
+    files maps each submission name to the sha256 of its content, and blobs
+    holds each distinct content once. Every run is committed as one
+    transaction on flush.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                content TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS files (
+                name TEXT PRIMARY KEY,
+                hash TEXT NOT NULL REFERENCES blobs(hash),
+                updated_at REAL NOT NULL
+            );
+        """)
+        self.conn.commit()
+
+    def exists(self, name):
+        with self.lock:
+            return self.conn.execute("SELECT 1 FROM files WHERE name = ?", (name,)).fetchone() is not None
+
+    def write(self, name, content):
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        with self.lock:
+            row = self.conn.execute("SELECT hash FROM files WHERE name = ?", (name,)).fetchone()
+            if row and row[0] == digest:
+                return False
+            self.conn.execute("INSERT OR IGNORE INTO blobs (hash, content) VALUES (?, ?)", (digest, content))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (name, hash, updated_at) VALUES (?, ?, ?)", (name, digest, time.time())
+            )
+            return True
+
+    def flush(self):
+        with self.lock:
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+    def describe(self, name):
+        return f"{self.path}:{name}"
+
+sinks = {}
+sinks_lock = threading.Lock()
+
+def open_sink(target):
+    """The shared sink for an output target, picked by its extension (anything else is a directory)"""
+    with sinks_lock:
+        if target not in sinks:
+            lower = target.lower()
+            if lower.endswith((".zip", ".tar", ".tar.gz", ".tgz")):
+                sinks[target] = ArchiveSink(target)
+            elif lower.endswith((".db", ".sqlite", ".sqlite3")):
+                sinks[target] = SqliteSink(target)
+            else:
+                sinks[target] = DirectorySink(target)
+        return sinks[target]
+
+def close_sinks():
+    """Close every sink opened so far; an archive drops its replaced entries here"""
+    with sinks_lock:
+        for sink in sinks.values():
+            sink.close()
+        sinks.clear()
+
+# Sheet backends: where Contest reads rows from and writes timestamps to.
+# A backend has open_spreadsheet(url) returning an object with .id and
+# .worksheet(name), plus the HTTP session for the Drive revision check (or
+# None) and the write quota budget to pace writes with (or None).
+
+def client_session(client):
+    """The authorized requests session behind a gspread client (gspread 5 and 6)"""
+    return getattr(getattr(client, "http_client", client), "session", None)
+
+class GspreadBackend:
+    """Google Sheets through one authorized gspread client"""
+
+    def __init__(self, client, read_quota=READ_QUOTA_PER_MINUTE, write_quota=WRITE_QUOTA_PER_MINUTE):
+        self.client = client
+        self.session = client_session(client)
+        # Shared by every contest: the quota is per service account, not per sheet
+        self.read_bucket = TokenBucket(read_quota, "Read")
+        self.write_bucket = TokenBucket(write_quota, "Write")
+        self.spreadsheets = {}
+        self.lock = threading.Lock()
+
+    def open_spreadsheet(self, url):
+        # Contests on the same spreadsheet share one open call
+        with self.lock:
+            if url not in self.spreadsheets:
+                self.spreadsheets[url] = self.client.open_by_url(url)
+            return self.spreadsheets[url]
+
+def parse_a1_range(range_str):
+    """Split an A1 range like "A5:Z", "B1:B" or "E7" into 0-based (first_row, first_col, last_row, last_col).
+
+    Open ends (no row number) are returned as None.
+    """
+    match = re.fullmatch(r"([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?", range_str)
+    if not match:
+        raise ValueError(f"Unsupported range: {range_str}")
+    col1, row1, col2, row2 = match.groups()
+    if col2 is None:
+        col2, row2 = col1, row1
+
+    def col_number(letters):
+        n = 0
+        for ch in letters:
+            n = n * 26 + ord(ch) - 64
+        return n - 1
+
+    first_row = int(row1) - 1 if row1 else 0
+    last_row = int(row2) - 1 if row2 else None
+    return first_row, col_number(col1), last_row, col_number(col2)
+
+class FileWorksheet:
+    """A worksheet held in memory, answering batch_get/update_cells like the Sheets API"""
+
+    def __init__(self, spreadsheet, rows):
+        self.spreadsheet = spreadsheet
+        self.rows = rows
+
+    def batch_get(self, ranges):
+        self.spreadsheet.reload_if_changed()
+        result = []
+        for range_str in ranges:
+            first_row, first_col, last_row, last_col = parse_a1_range(range_str)
+            values = []
+            for row in self.rows[first_row:None if last_row is None else last_row + 1]:
+                cells = [str(cell) for cell in row[first_col:last_col + 1]]
+                # The API leaves out trailing empty cells and trailing empty rows
+                while cells and cells[-1] == "":
+                    cells.pop()
+                values.append(cells)
+            while values and not values[-1]:
+                values.pop()
+            result.append(values)
+        return result
+
+    def update_cells(self, cells, value_input_option=None):
+        for cell in cells:
+            while len(self.rows) < cell.row:
+                self.rows.append([])
+            row = self.rows[cell.row - 1]
+            row.extend([""] * (cell.col - len(row)))
+            row[cell.col - 1] = str(cell.value)
+        self.spreadsheet.save()
+
+class FileSpreadsheet:
+    """A CSV or JSON file standing in for a spreadsheet.
+
+    A CSV file is a single sheet served under any name. A JSON file holds
+    either a list of rows or {"sheet name": [rows...]}. The file is reread
+    whenever it changes on disk, so new submissions can be appended to it
+    while watching.
+    """
+
+    def __init__(self, path, persist=True):
+        self.id = self.path = path
+        self.persist = persist  # write timestamp updates back to the file
+        self.lock = threading.Lock()
+        self.worksheets = {}
+        self.mtime = None
+        self.load()
+
+    def load(self):
+        if self.path.lower().endswith(".csv"):
+            with open(self.path, "r", encoding="utf-8", newline="") as f:
+                sheets = {None: [row for row in csv.reader(f)]}
+        else:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            sheets = data if isinstance(data, dict) else {None: data}
+        for name, rows in sheets.items():
+            if name in self.worksheets:
+                self.worksheets[name].rows = rows
+            else:
+                self.worksheets[name] = FileWorksheet(self, rows)
+        self.mtime = os.stat(self.path).st_mtime_ns
+
+    def reload_if_changed(self):
+        with self.lock:
+            if os.stat(self.path).st_mtime_ns != self.mtime:
+                self.load()
+
+    def save(self):
+        if not self.persist:
+            return
+        with self.lock:
+            if None in self.worksheets:
+                rows = self.worksheets[None].rows
+            else:
+                rows = {name: worksheet.rows for name, worksheet in self.worksheets.items()}
+            if self.path.lower().endswith(".csv"):
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(rows)
+                content = buffer.getvalue()
+            else:
+                content = json.dumps(rows, ensure_ascii=False)
+            write_file_atomic(self.path, content, {})
+            self.mtime = os.stat(self.path).st_mtime_ns
+
+    def worksheet(self, name):
+        if None in self.worksheets:
+            return self.worksheets[None]
+        if name not in self.worksheets:
+            raise ValueError(f"No sheet named {name!r} in {self.path}")
+        return self.worksheets[name]
+
+class FileBackend:
+    """Local CSV/JSON files instead of Google Sheets: no network, no write quota"""
+
+    def __init__(self, path, persist=True):
+        self.path = path
+        self.persist = persist
+        self.session = None
+        self.read_bucket = None
+        self.write_bucket = None
+        self.spreadsheet = None
+        self.lock = threading.Lock()
+
+    def open_spreadsheet(self, url):
+        # Every contest reads the same file; sheet names pick the tab in a JSON file
+        with self.lock:
+            if self.spreadsheet is None:
+                self.spreadsheet = FileSpreadsheet(self.path, persist=self.persist)
+            return self.spreadsheet
+
+class RecordingWorksheet:
+    """Passes calls through to a real worksheet and appends each call and its result to a log"""
+
+    def __init__(self, worksheet, recorder, sheet_name):
+        self.worksheet = worksheet
+        self.recorder = recorder
+        self.sheet_name = sheet_name
+        self.spreadsheet = worksheet.spreadsheet
+
+    def batch_get(self, ranges):
+        result = [[list(row) for row in values] for values in self.worksheet.batch_get(ranges)]
+        self.recorder.record({"sheet": self.sheet_name, "method": "batch_get", "ranges": list(ranges), "result": result})
+        return result
+
+    def update_cells(self, cells, value_input_option=None):
+        self.worksheet.update_cells(cells, value_input_option=value_input_option)
+        self.recorder.record({"sheet": self.sheet_name, "method": "update_cells",
+                              "cells": [[cell.row, cell.col, cell.value] for cell in cells]})
+
+class RecordingSpreadsheet:
+    def __init__(self, spreadsheet, recorder):
+        self.spreadsheet = spreadsheet
+        self.recorder = recorder
+        self.id = spreadsheet.id
+
+    def worksheet(self, name):
+        return RecordingWorksheet(self.spreadsheet.worksheet(name), self.recorder, name)
+
+class RecordingBackend:
+    """Wraps another backend and records every sheet call to a JSON lines file for ReplayBackend"""
+
+    def __init__(self, backend, path):
+        self.backend = backend
+        self.path = path
+        self.session = backend.session
+        self.read_bucket = backend.read_bucket
+        self.write_bucket = backend.write_bucket
+        self.lock = threading.Lock()
+        # Start a new recording rather than appending to an older one
+        open(path, "w", encoding="utf-8").close()
+
+    def open_spreadsheet(self, url):
+        return RecordingSpreadsheet(self.backend.open_spreadsheet(url), self)
+
+    def record(self, entry):
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+class ReplayWorksheet:
+    """Answers batch_get from a recording, in the order the calls were recorded"""
+
+    def __init__(self, spreadsheet, responses, sheet_name):
+        self.spreadsheet = spreadsheet
+        self.responses = responses
+        self.sheet_name = sheet_name
+        self.updated_cells = 0
+
+    def batch_get(self, ranges):
+        key = (self.sheet_name, tuple(ranges))
+        queue = self.responses.get(key)
+        if not queue:
+            raise ValueError(f"No recorded response left for {list(ranges)} on sheet {self.sheet_name!r}")
+        return queue.popleft()
+
+    def update_cells(self, cells, value_input_option=None):
+        # Writes are accepted and dropped: the recording already holds what the sheet returned afterwards
+        self.updated_cells += len(cells)
+
+class ReplaySpreadsheet:
+    def __init__(self, path, responses):
+        self.id = path
+        self.responses = responses
+
+    def worksheet(self, name):
+        return ReplayWorksheet(self, self.responses, name)
+
+class ReplayBackend:
+    """Serves a recording made with RecordingBackend, without network access"""
+
+    def __init__(self, path):
+        self.path = path
+        self.session = None
+        self.read_bucket = None
+        self.write_bucket = None
+        self.responses = {}  # (sheet name, ranges) -> deque of recorded results
+        self.sheet_names = []  # sheets in the recording, in the order they were first used
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
                     continue
-            
-            if dt is None:
-                skipped_count += 1
-                continue
-            
-            # Convert to UNIX timestamp for comparison
-            unix_timestamp = int(time.mktime(dt.timetuple()))
-            
-            # Skip if incremental mode and timestamp is not newer
-            if incremental and unix_timestamp <= last_checked_timestamp:
-                skipped_count += 1
-                continue
-            
-            # Track the maximum timestamp seen
-            current_max_timestamp = max(current_max_timestamp, unix_timestamp)
-            
-        except (ValueError, IndexError):
-            skipped_count += 1
-            continue
-        
-        # Map password to username if the SBD is a password
-        actual_username = sbd
-        if sbd in password_to_username:
-            actual_username = password_to_username[sbd]
-        elif sbd not in users:
-            skipped_count += 1
-            continue
-        
-        mabai = row[idx_mabai].strip().upper() if idx_mabai < len(row) else ""
-        if not mabai:
-            skipped_count += 1
-            continue
-            
-        key = (actual_username, mabai)
-        if key not in subs:
-            subs[key] = []
-            row_map[key] = []
-        subs[key].append((dt, row_num, row))
-        row_map[key].append(row_num)
-        processed_count += 1
-
-    print(f"Found {len(subs)} unique (user, problem) combinations to process from {processed_count} valid rows (skipped {skipped_count} rows)")
-
-    # Batch updates for Google Sheets
-    batch_updates = []
-    
-    # For each (user, mabai), pick first or last
-    for key, sublist in subs.items():
-        if sub_order == "first":
-            chosen = min(sublist, key=lambda x: x[0])
+                entry = json.loads(line)
+                if entry["sheet"] not in self.sheet_names:
+                    self.sheet_names.append(entry["sheet"])
+                if entry["method"] == "batch_get":
+                    key = (entry["sheet"], tuple(entry["ranges"]))
+                    self.responses.setdefault(key, deque()).append(entry["result"])
+
+    def open_spreadsheet(self, url):
+        return ReplaySpreadsheet(self.path, self.responses)
+
+class Contest:
+    """One (spreadsheet, sheet) pair being collected or cleaned up, with all of its watch state"""
+
+    def __init__(self, spreadsheet_url, sheet_name, command="collect", sub_order="last", start_row=2,
+                 contest_id=None, users_file="users.txt", output_dir="BaiLam", projected_fetch=False,
+                 watch_interval=5, state_file="watch_state.db", fresh_start=False, label=None, page_size=None,
+                 shards=1, adaptive=False, max_interval=ADAPTIVE_MAX_INTERVAL, ledger_file=None, quiet=False):
+        if not sheet_name:
+            raise ValueError("Missing sheet name (SHEETNAME)")
+        if not spreadsheet_url:
+            raise ValueError("Missing spreadsheet URL (SPREADSHEET_URL)")
+
+        self.spreadsheet_url = spreadsheet_url
+        self.sheet_name = sheet_name
+        self.command = command
+        self.sub_order = sub_order
+        self.start_row = start_row
+        self.contest_id = contest_id
+        self.users_file = users_file
+        self.output_dir = output_dir
+        self.projected_fetch = projected_fetch
+        self.watch_interval = watch_interval
+        self.state_file = state_file
+        self.fresh_start = fresh_start
+        self.label = label  # prefix for log lines when several contests share the output
+        self.page_size = page_size  # rows per page in streaming mode, None to cache the whole sheet
+        self.shards = shards  # concurrent requests a large row range is split into
+        self.adaptive = adaptive  # adapt the poll interval between watch_interval and max_interval
+        self.max_interval = max(max_interval, watch_interval)
+        self.interval = watch_interval  # current adaptive cadence
+        self.effective_interval = watch_interval  # cadence after the quota floor
+        self.requests_per_poll = None  # (reads, writes) per poll, smoothed
+        self.quota_share = 1.0  # fraction of the quota budget this contest may use
+        self.error_streak = 0
+        self.ledger_file = ledger_file  # record processed rows here instead of writing to the sheet
+        self.ledger = None
+        self.quiet = quiet  # only log warnings, errors and one summary line per iteration
+        self.metrics = Metrics()  # phases and counters of the current iteration
+        self.metrics_exporter = None
+        self.profiler = None  # set by --profile
+        self.prechecker = None  # set by --precheck
+
+        self.sheet = None
+        self.session = None  # authorized HTTP session, used for the Drive revision check
+        self.read_bucket = None  # read quota budget, None for backends without one
+        self.write_bucket = None  # write quota budget, None for backends without one
+        self.read_count = 0  # read requests sent, for the adaptive scheduler
+        self.write_count = 0
+        self.metadata_check = True
+        self.known_version = None  # Drive revision of the spreadsheet when last fully processed
+        self.triggered = threading.Event()  # set by the webhook listener to poll ahead of schedule
+        self.webhook_poll = False  # the next poll was triggered by a webhook
+        self.header = []
+        self.rows = []
+        self.timestamp_parser = TimestampParser()
+        self.parse_timestamp = self.timestamp_parser.parse
+        self.iteration = 0
+
+        # Track last checked timestamp for incremental processing
+        self.last_checked_timestamp = 0
+
+        # Rows whose cells we wrote back since the last refresh (1-based row numbers)
+        self.written_rows = set()
+
+        # Content hash of every output file we have written or checked (filepath -> sha256)
+        self.sink = None  # where collected files go, opened from output_dir
+
+        # Current first/last winner per (username, mabai) across watch iterations: key -> (unix_timestamp, row_num).
+        # Shared by collect and cleanup; the row number is informational and may go stale after row deletions.
+        self.winner_index = {}
+        self.winner_dirty = set()  # winner index keys changed since the last save_state
+
+        # How far the cached rows have been scanned. While the cache is only appended to,
+        # incremental runs start after this point instead of rescanning the whole sheet.
+        self.scanned_rows = None  # the rows list object last scanned
+        self.scanned_row_count = 0
+
+        # Watch state persisted across restarts (watch mode only)
+        self.state_db = None
+        self.saved_state = None
+        self.state_saved_rows = None  # the rows list object last written to the state database
+        self.state_saved_row_count = 0
+        self.state_dirty_rows = set()  # cached rows patched in place since the last save (1-based)
+
+    def log(self, message=""):
+        if self.quiet and not message.lstrip().startswith(("⚠️", "❌")):
+            return
+        self.print(message)
+
+    def print(self, message):
+        if self.label:
+            # Keep leading blank lines outside the prefix so banners still stand out
+            stripped = message.lstrip("\n")
+            print(f"{message[:len(message) - len(stripped)]}[{self.label}] {stripped}")
         else:
-            chosen = max(sublist, key=lambda x: x[0])
-        dt, row_num, row = chosen
-        unix_ts = int(time.mktime(dt.timetuple()))
-        sbd = row[idx_sbd].strip() if idx_sbd < len(row) else ""
-        batch_updates.append((row_num, idx_timestamp + 1, unix_ts))
-        print(f"Marked as collected for SBD {sbd}")
-
-    # Batch update all timestamps at once using a single API call
-    if batch_updates:
-        print(f"Updating {len(batch_updates)} timestamps in Google Sheets (single API call)...")
+            print(message)
+
+    def open(self, backend, watch_mode=False):
+        """Open the sheet through a backend, load users and the initial rows (or the saved watch state)"""
+        self.session = backend.session
+        self.read_bucket = backend.read_bucket
+        self.write_bucket = backend.write_bucket
         try:
-            # Use gspread.Cell for efficient batch updates in one request
-            cells = [gspread.Cell(r, c, v) for (r, c, v) in batch_updates]
-            sheet.update_cells(cells, value_input_option="USER_ENTERED")
-            print("✅ All timestamps updated in one batch")
+            self.sheet = backend.open_spreadsheet(self.spreadsheet_url).worksheet(self.sheet_name)
         except Exception as e:
-            print(f"⚠️ Error updating timestamps: {e}")
-            # Exponential backoff on error
-            time.sleep(random.uniform(1, 3))
-            raise
-    
-    # Update last checked timestamp for incremental mode
-    if current_max_timestamp > last_checked_timestamp:
-        last_checked_timestamp = current_max_timestamp
-        print(f"📊 Updated last checked timestamp to: {last_checked_timestamp}")
-    
-    print(f"✅ Cleanup complete. Processed {len(subs)} unique (user, problem) combinations.")
-
-# Main execution
-if watch_mode:
-    # Format interval display
-    if watch_interval < 60:
-        interval_str = f"{watch_interval}s"
-    elif watch_interval < 3600:
-        interval_str = f"{watch_interval // 60}m"
-    else:
-        interval_str = f"{watch_interval // 3600}h"
-    
-    print(f"🔄 Watch mode enabled. Running {command} every {interval_str}. Press Ctrl+C to stop.")
-    print("🚀 Using incremental mode for better performance")
-    iteration = 1
-    
-    # First run - full scan
-    if command == "collect":
-        run_collect(incremental=False)
-    elif command == "cleanup":
-        run_cleanup(incremental=False)
-    
-    iteration += 1
-    
-    while True:
+            raise ValueError(f"Cannot open spreadsheet: {e}, maybe the sheet name is wrong?")
+
+        if watch_mode:
+            self.state_db = self.open_state_db()
+            if not self.fresh_start:
+                self.saved_state = self.load_state()
+
+        # Initial data load (projected mode only needs the header until column indices and users are known)
+        if self.saved_state:
+            self.rows = self.saved_state[2]
+            self.state_saved_rows = self.rows
+            self.state_saved_row_count = len(self.rows)
+            self.log(f"♻️ Resumed {len(self.rows)} cached rows from {self.state_file}")
+        elif self.projected_fetch or self.page_size:
+            # Streaming mode fetches the rows page by page while running
+            self.rows = self.get_sheet_data(1, 1)
+        else:
+            self.rows = self.get_sheet_data()
+            self.log(f"Sheet has {len(self.rows)} total rows (including header)")
+
+        self.set_header(self.rows[0])
+        self.log(f"Column indices: timestamp={self.idx_timestamp}, sbd={self.idx_sbd}, lang={self.idx_lang}, mabai={self.idx_mabai}, code={self.idx_code}")
+
+        if self.saved_state:
+            self.last_checked_timestamp = self.saved_state[1]
+            self.winner_index = self.saved_state[3]
+
+        # Set file_id once (either custom contest_id, the one saved in watch state, or random)
+        if self.contest_id:
+            self.file_id = self.contest_id
+            self.log(f"Using contest ID: {self.file_id}")
+        elif self.saved_state:
+            self.file_id = self.saved_state[0]
+            self.log(f"Using saved random ID: {self.file_id}")
+        else:
+            self.file_id = random.randint(1, int(1e9))
+            self.log(f"Using random ID: {self.file_id}")
+
+        # Read the users file; also create reverse mapping: password -> username
+        if self.command == "collect":
+            self.sink = open_sink(self.output_dir)
+        if self.ledger_file:
+            self.ledger = Ledger(self.ledger_file, f"{self.spreadsheet_url}|{self.sheet_name}|{self.command}")
+            self.log(f"📒 Recording processed rows in {self.ledger_file} ({len(self.ledger.row_hashes)} so far), the sheet is read-only")
+        self.roster = Roster(self.users_file)
+        self.roster.reload()
+        self.users, self.password_to_username = self.roster.users, self.roster.password_to_username
+        self.log(f"Loaded {len(self.users)} users with unique passwords")
+
+        if self.projected_fetch and not self.saved_state and not self.page_size:
+            self.rows = self.get_projected_rows()
+            self.log(f"Sheet has {len(self.rows)} total rows (including header, projected fetch)")
+
+    def check(self, offline=False):
+        """Validate the settings without touching the network (--dry-run). Returns a list of problems"""
+        problems = []
+        name = self.label or self.sheet_name
         try:
-            print(f"\n{'='*60}")
-            print(f"🔄 Watch iteration #{iteration} - {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-            print(f"{'='*60}\n")
-            
-            # Check if there are new rows by checking total row count
-            current_row_count = len(rows)
-            
-            # First, quickly check row count to see if anything changed
-            try:
-                # Get just the first cell to check total rows efficiently
-                all_data = sheet.batch_get(["A:A"])
-                new_row_count = len(all_data[0]) if all_data and len(all_data) > 0 else 0
-                
-                if new_row_count > current_row_count:
-                    print(f"📥 Detected {new_row_count - current_row_count} new rows")
-                    rows = get_sheet_data()
-                    print(f"📊 Sheet now has {len(rows)} total rows")
-                elif new_row_count < current_row_count:
-                    print("📥 Detected row deletion, refreshing data...")
-                    rows = get_sheet_data()
-                    print(f"📊 Sheet now has {len(rows)} total rows")
-                else:
-                    # No new rows, check if last row content changed
-                    if current_row_count > 0:
-                        last_row_data = sheet.batch_get([f"A{current_row_count}:Z{current_row_count}"])
-                        if last_row_data and len(last_row_data) > 0 and len(last_row_data[0]) > 0:
-                            last_row_new = last_row_data[0][0]
-                            last_row_old = rows[-1]
-                            # Compare row contents
-                            if last_row_new != last_row_old:
-                                print("📥 Detected changes in existing rows, fetching latest data...")
-                                rows = get_sheet_data()
-                                print(f"📊 Sheet now has {len(rows)} total rows")
-                            else:
-                                print("✓ No changes detected, using incremental mode")
+            self.roster = Roster(self.users_file)
+            self.roster.reload()
+        except (OSError, ValueError) as e:
+            problems.append(f"{name}: {e}")
+        if not offline and "/spreadsheets/d/" not in self.spreadsheet_url:
+            problems.append(f"{name}: {self.spreadsheet_url} is not a Google Sheets URL")
+        targets = [self.state_file, self.ledger_file]
+        if self.command == "collect":
+            targets.append(self.output_dir)
+        for target in filter(None, targets):
+            directory = os.path.dirname(os.path.abspath(target))
+            while not os.path.exists(directory):
+                directory = os.path.dirname(directory)
+            if not os.access(directory, os.W_OK):
+                problems.append(f"{name}: cannot write {target}")
+        return problems
+
+    def take_token(self, bucket):
+        """Take one token from a quota budget, waiting until it is available"""
+        wait_time = bucket.acquire()
+        if wait_time:
+            self.log(f"⚠️ {bucket.kind} quota budget used up, waiting {wait_time:.1f}s...")
+            time.sleep(wait_time)
+
+    def read(self, ranges):
+        """batch_get ranges from the sheet, taking one token from the read quota budget"""
+        if self.read_bucket is not None:
+            self.take_token(self.read_bucket)
+        self.read_count += 1
+        started = time.perf_counter()
+        data = self.sheet.batch_get(ranges)
+        metrics = self.metrics
+        metrics.add_time("fetch", time.perf_counter() - started)
+        metrics.count("read_requests")
+        # Size of the returned cell text, close to the response size without touching the HTTP layer
+        metrics.count("bytes_fetched", sum(len(cell.encode("utf-8")) for values in data for row in values for cell in row if cell))
+        return data
+
+    # Efficient data fetching using batch_get
+    def get_sheet_data(self, start_row_num=1, end_row_num=None):
+        """Fetch sheet data efficiently using batch_get"""
+        if self.shards > 1:
+            rows = self.get_sheet_data_sharded(start_row_num, end_row_num)
+            if rows is not None:
+                return rows
+
+        # Don't include sheet name in range - worksheet.batch_get() already operates on this sheet
+        if end_row_num is None:
+            range_str = f"A{start_row_num}:Z"
+        else:
+            range_str = f"A{start_row_num}:Z{end_row_num}"
+
+        try:
+            data = self.read([range_str])
+            if data and len(data) > 0:
+                return data[0]
+            return []
+        except Exception as e:
+            self.log(f"⚠️ Error fetching data: {e}")
+            # Exponential backoff on error
+            time.sleep(random.uniform(1, 3))
+            raise
+
+    def get_sheet_data_sharded(self, start_row_num, end_row_num):
+        """Fetch a large range as row shards on a thread pool, reassembled in order.
+
+        Without an end row, column A tells how far the sheet goes; the last shard
+        stays open-ended so rows with an empty column A are still included.
+        Returns None when the range is too small to be worth splitting.
+        """
+        last_row_num = end_row_num
+        if last_row_num is None:
+            col_a = self.fetch_range(f"A{start_row_num}:A")
+            last_row_num = start_row_num + len(col_a) - 1
+        row_count = last_row_num - start_row_num + 1
+        shard_rows = max(SHARD_MIN_ROWS, -(-row_count // self.shards))
+        if row_count <= shard_rows:
+            return None
+
+        shard_starts = list(range(start_row_num, last_row_num + 1, shard_rows))
+        ranges = [f"A{first}:Z{first + shard_rows - 1}" for first in shard_starts[:-1]]
+        ranges.append(f"A{shard_starts[-1]}:Z{'' if end_row_num is None else end_row_num}")
+        self.log(f"📥 Fetching rows {start_row_num}-{last_row_num} in {len(ranges)} shards...")
+
+        with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+            shards = list(pool.map(self.fetch_range, ranges))
+
+        rows = []
+        for shard in shards[:-1]:
+            # The API drops trailing empty rows, pad them back so later shards keep their row numbers
+            rows.extend(shard)
+            rows.extend([] for _ in range(shard_rows - len(shard)))
+        rows.extend(shards[-1])
+        while rows and not rows[-1]:
+            rows.pop()
+        return rows
+
+    def fetch_range(self, range_str):
+        """batch_get one range, retrying HTTP 429/5xx and network errors with backoff"""
+        for attempt in range(SHARD_MAX_RETRIES + 1):
+            try:
+                data = self.read([range_str])
+                return data[0] if data else []
+            except Exception as e:
+                status = error_status(e)
+                if (status is not None and status not in RETRYABLE_STATUS) or attempt == SHARD_MAX_RETRIES:
+                    self.log(f"⚠️ Error fetching {range_str}: {e}")
+                    raise
+                delay = retry_delay(e, attempt)
+                self.log(f"⚠️ Fetching {range_str} failed ({status or e}), retrying in {delay:.1f}s...")
+                time.sleep(delay)
+
+    def get_projected_rows(self, start_row_num=1, end_row_num=None, with_code=True):
+        """Two-phase fetch that downloads source code only for winning submissions.
+
+        Phase 1 pulls column A and the timestamp/SBD/lang/problem columns as
+        separate ranges in one batch_get. Phase 2 picks the first/last submission
+        per (user, problem) and fetches the code cell for those rows only.
+        Rows are returned full width; code cells that were not fetched are None.
+        """
+        idx_code = self.idx_code
+        meta_cols = sorted({0, self.idx_timestamp, self.idx_sbd, self.idx_lang, self.idx_mabai} - {idx_code})
+        width = max(meta_cols + [idx_code]) + 1
+        end = "" if end_row_num is None else end_row_num
+
+        try:
+            data = self.read([f"{col_letter(c)}{start_row_num}:{col_letter(c)}{end}" for c in meta_cols])
+        except Exception as e:
+            self.log(f"⚠️ Error fetching data: {e}")
+            time.sleep(random.uniform(1, 3))
+            raise
+
+        row_count = max((len(values) for values in data), default=0)
+        projected = [[""] * width for _ in range(row_count)]
+        for c, values in zip(meta_cols, data):
+            for i, cell in enumerate(values):
+                if cell:
+                    projected[i][c] = cell[0]
+        # Keep the full header so column indices can be found again from cached rows
+        if start_row_num == 1 and projected:
+            projected[0] = list(self.header)
+
+        self.detect_timestamp_format(projected)
+
+        # Pick the winner per (user, problem) using the same rules as run_collect
+        winners = {}
+        perf_counter = time.perf_counter
+        parse_time = 0.0
+        for row_num, row in enumerate(projected, start=start_row_num):
+            if row_num < self.start_row:
+                continue
+            row[idx_code] = None
+            if not with_code:
+                continue
+
+            sbd = row[self.idx_sbd].strip()
+            timestamp_str = row[self.idx_timestamp].strip()
+            if not sbd or not timestamp_str:
+                continue
+
+            parse_started = perf_counter()
+            unix_timestamp = self.parse_timestamp(timestamp_str)
+            parse_time += perf_counter() - parse_started
+            if unix_timestamp is None or unix_timestamp <= self.last_checked_timestamp:
+                continue
+
+            if sbd in self.password_to_username:
+                actual_username = self.password_to_username[sbd]
+            elif sbd in self.users:
+                actual_username = sbd
+            else:
+                continue
+
+            mabai = row[self.idx_mabai].strip().upper()
+            lang = row[self.idx_lang].strip().lower()
+            if not mabai or not ("c" in lang or "py" in lang):
+                continue
+
+            key = (actual_username, mabai)
+            # A winner from an earlier poll that still beats this row means its code is never needed
+            if not self.is_new_winner(self.winner_index.get(key), unix_timestamp):
+                continue
+            if self.is_new_winner(winners.get(key), unix_timestamp):
+                winners[key] = (unix_timestamp, row_num)
+
+        self.metrics.add_time("parse", parse_time)
+        winner_rows = sorted(row_num for _, row_num in winners.values())
+        if winner_rows:
+            code_letter = col_letter(idx_code)
+            self.log(f"📥 Fetching code for {len(winner_rows)} winning submissions out of {len(projected)} rows")
+            try:
+                code_data = self.read([f"{code_letter}{r}" for r in winner_rows])
             except Exception as e:
-                print(f"⚠️ Error checking for changes: {e}, doing full refresh...")
+                self.log(f"⚠️ Error fetching code: {e}")
                 time.sleep(random.uniform(1, 3))
-                rows = get_sheet_data()
-            
+                raise
+            for row_num, values in zip(winner_rows, code_data):
+                projected[row_num - start_row_num][idx_code] = values[0][0] if values and values[0] else ""
+
+        return projected
+
+    def fetch_rows(self, start_row_num=1, end_row_num=None):
+        """Fetch rows using the configured fetch mode (full A:Z or projected)"""
+        if self.projected_fetch:
+            return self.get_projected_rows(start_row_num, end_row_num, with_code=(self.command == "collect"))
+        return self.get_sheet_data(start_row_num, end_row_num)
+
+    def state_key(self):
+        """Key identifying this watcher's saved state: sheet, contest and processing mode"""
+        fetch_mode = "projected" if self.projected_fetch else "full"
+        return f"{self.spreadsheet_url}|{self.sheet_name}|{self.contest_id or ''}|{self.command}|{self.sub_order}|{fetch_mode}"
+
+    def open_state_db(self):
+        """Open the watch state database, creating its tables on first use"""
+        # Polls run on worker threads, one at a time per contest
+        conn = sqlite3.connect(self.state_file, timeout=30, check_same_thread=False)
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS watch_state (
+                state_key TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL,
+                last_checked_timestamp INTEGER NOT NULL,
+                row_count INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS watch_rows (
+                state_key TEXT NOT NULL,
+                row_num INTEGER NOT NULL,
+                data TEXT NOT NULL,
+                PRIMARY KEY (state_key, row_num)
+            );
+            CREATE TABLE IF NOT EXISTS watch_winners (
+                state_key TEXT NOT NULL,
+                username TEXT NOT NULL,
+                mabai TEXT NOT NULL,
+                unix_timestamp INTEGER NOT NULL,
+                row_num INTEGER NOT NULL,
+                PRIMARY KEY (state_key, username, mabai)
+            );
+        """)
+        return conn
+
+    def load_state(self):
+        """Return (file_id, last_checked_timestamp, rows, winner_index) saved for this watcher, or None"""
+        key = self.state_key()
+        saved = self.state_db.execute(
+            "SELECT file_id, last_checked_timestamp, row_count FROM watch_state WHERE state_key = ?", (key,)
+        ).fetchone()
+        if saved is None:
+            return None
+
+        saved_file_id, saved_timestamp, row_count = saved
+        saved_rows = []
+        for expected_row_num, (row_num, data) in enumerate(
+            self.state_db.execute("SELECT row_num, data FROM watch_rows WHERE state_key = ? ORDER BY row_num", (key,)),
+            start=1,
+        ):
+            # A gap means the snapshot was cut short, so it cannot be trusted
+            if row_num != expected_row_num:
+                return None
+            saved_rows.append(json.loads(data))
+        if len(saved_rows) != row_count or not saved_rows:
+            return None
+        winners = {
+            (username, mabai): (unix_timestamp, row_num)
+            for username, mabai, unix_timestamp, row_num in self.state_db.execute(
+                "SELECT username, mabai, unix_timestamp, row_num FROM watch_winners WHERE state_key = ?", (key,)
+            )
+        }
+        return saved_file_id, saved_timestamp, saved_rows, winners
+
+    def save_state(self):
+        """Persist the watermark, the winner index and any rows that changed since the last save"""
+        if self.state_db is None:
+            return
+
+        rows = self.rows
+        key = self.state_key()
+        if rows is not self.state_saved_rows:
+            # The cache was replaced by a full refetch, rewrite every row
+            changed = range(1, len(rows) + 1)
+        else:
+            changed = sorted(self.state_dirty_rows.union(range(self.state_saved_row_count + 1, len(rows) + 1)))
+
+        if rows is not self.state_saved_rows:
+            winners = self.winner_index.keys()
+        else:
+            winners = self.winner_dirty
+
+        with self.state_db:
+            if rows is not self.state_saved_rows:
+                self.state_db.execute("DELETE FROM watch_rows WHERE state_key = ?", (key,))
+                self.state_db.execute("DELETE FROM watch_winners WHERE state_key = ?", (key,))
+            elif len(rows) < self.state_saved_row_count:
+                self.state_db.execute("DELETE FROM watch_rows WHERE state_key = ? AND row_num > ?", (key, len(rows)))
+            self.state_db.executemany(
+                "INSERT OR REPLACE INTO watch_rows (state_key, row_num, data) VALUES (?, ?, ?)",
+                [(key, r, json.dumps(rows[r - 1], ensure_ascii=False)) for r in changed if r <= len(rows)],
+            )
+            self.state_db.executemany(
+                "INSERT OR REPLACE INTO watch_winners (state_key, username, mabai, unix_timestamp, row_num) VALUES (?, ?, ?, ?, ?)",
+                [(key, username, mabai) + self.winner_index[username, mabai] for username, mabai in winners],
+            )
+            self.state_db.execute(
+                "INSERT OR REPLACE INTO watch_state (state_key, file_id, last_checked_timestamp, row_count, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (key, str(self.file_id), self.last_checked_timestamp, len(rows), time.time()),
+            )
+
+        self.state_saved_rows = rows
+        self.state_saved_row_count = len(rows)
+        self.state_dirty_rows.clear()
+        self.winner_dirty.clear()
+
+    def row_hash(self, row):
+        """Short hash of a row's timestamp/SBD/language/problem cells, identifying its submission in the ledger"""
+        cells = [
+            row[i] if i < len(row) and row[i] is not None else ""
+            for i in (self.idx_timestamp, self.idx_sbd, self.idx_lang, self.idx_mabai)
+        ]
+        return hashlib.sha256("\x1f".join(cells).encode("utf-8")).hexdigest()[:16]
+
+    def mark_processed(self, batch_updates, row_hashes):
+        """Mark (row, col, unix_timestamp) rows as processed: in the ledger if there is one, else in the sheet"""
+        if self.ledger is None:
+            self.write_back(batch_updates)
+            return
+        self.ledger.record([(row_num, row_hashes[row_num], unix_ts) for row_num, _, unix_ts in batch_updates])
+        self.log(f"📒 Recorded {len(batch_updates)} rows in {self.ledger_file}, sheet left untouched")
+
+    def flush_ledger(self):
+        """Write the timestamps of every pending ledger row back to the sheet in one batched pass.
+
+        Rows whose cells no longer match the recorded hash hold a different
+        submission now and are left alone.
+        """
+        pending = self.ledger.pending()
+        if not pending:
+            self.log("📒 Ledger has nothing left to write back")
+            return
+        rows, col = self.rows, self.idx_timestamp + 1
+        updates = [
+            (row_num, col, unix_ts) for row_num, row_hash, unix_ts in pending
+            if row_num <= len(rows) and self.row_hash(rows[row_num - 1]) == row_hash
+        ]
+        if len(updates) < len(pending):
+            self.log(f"⚠️ {len(pending) - len(updates)} ledger rows changed in the sheet since, not writing them back")
+        if updates:
+            self.write_back(updates)
+        self.ledger.mark_flushed([row_num for row_num, _, _ in pending])
+        self.log(f"📒 Wrote {len(updates)} ledger rows back to the sheet")
+
+    def write_back(self, batch_updates):
+        """Write (row, col, value) cell updates to the sheet in size-bounded chunks.
+
+        Every request takes a token from the write quota budget. A chunk that fails
+        with HTTP 429/5xx or a network error is retried on its own with exponential
+        backoff, honouring Retry-After. Chunks that succeed are mirrored into the
+        cached rows right away. Raises if any chunk still failed in the end.
+        """
+        chunks = [batch_updates[i:i + WRITE_CHUNK_SIZE] for i in range(0, len(batch_updates), WRITE_CHUNK_SIZE)]
+        self.log(f"Updating {len(batch_updates)} timestamps in Google Sheets ({len(chunks)} request(s))...")
+
+        failed_count = 0
+        last_error = None
+        for chunk in chunks:
+            for attempt in range(WRITE_MAX_RETRIES + 1):
+                if self.write_bucket is not None:
+                    self.take_token(self.write_bucket)
+                self.write_count += 1
+                self.metrics.count("write_requests")
+                try:
+                    # One update_cells request per chunk
+                    cells = [Cell(r, c, v) for (r, c, v) in chunk]
+                    with self.metrics.phase("update_cells"):
+                        self.sheet.update_cells(cells, value_input_option="USER_ENTERED")
+                    self.metrics.count("cells_written", len(chunk))
+                    if not self.page_size:
+                        self.apply_local_updates(chunk)
+                    break
+                except Exception as e:
+                    status = error_status(e)
+                    if (status is not None and status not in RETRYABLE_STATUS) or attempt == WRITE_MAX_RETRIES:
+                        self.log(f"⚠️ Error updating timestamps for rows {chunk[0][0]}-{chunk[-1][0]}: {e}")
+                        failed_count += len(chunk)
+                        last_error = e
+                        break
+                    if status == 429 and self.write_bucket is not None:
+                        self.write_bucket.drain()
+                    delay = retry_delay(e, attempt)
+                    self.log(f"⚠️ Write failed ({status or e}), retrying {len(chunk)} cells in {delay:.1f}s...")
+                    time.sleep(delay)
+
+        if last_error is not None:
+            raise RuntimeError(f"{failed_count} of {len(batch_updates)} timestamp updates failed") from last_error
+        self.log("✅ All timestamps updated")
+
+    def apply_local_updates(self, batch_updates):
+        """Mirror written cells into the cached rows so the next refresh can skip them"""
+        rows = self.rows
+        for row_num, col, value in batch_updates:
+            self.written_rows.add(row_num)
+            self.state_dirty_rows.add(row_num)
+            if row_num - 1 < len(rows):
+                row = rows[row_num - 1]
+                if col - 1 < len(row):
+                    row[col - 1] = str(value)
+
+    def is_new_winner(self, current, unix_timestamp):
+        """Whether a submission beats the current (unix_timestamp, row_num) winner under --first/--last"""
+        if current is None:
+            return True
+        if self.sub_order == "first":
+            return unix_timestamp < current[0]
+        # Ties go to the later submission, which is processed after the current winner
+        return unix_timestamp >= current[0]
+
+    def update_winner_index(self, key, unix_timestamp, row_num):
+        """Record a submission in the winner index; returns True if it is the winner for its key"""
+        current = self.winner_index.get(key)
+        # A row seen again (e.g. after a failed write-back) keeps its win
+        if current is not None and current[1] == row_num:
+            return True
+        if not self.is_new_winner(current, unix_timestamp):
+            return False
+        self.winner_index[key] = (unix_timestamp, row_num)
+        self.winner_dirty.add(key)
+        return True
+
+    def first_row_to_scan(self, incremental):
+        """1-based row to start scanning from, past the already scanned rows when possible"""
+        if incremental and self.rows is self.scanned_rows:
+            return max(self.start_row, self.scanned_row_count + 1)
+        return self.start_row
+
+    def mark_rows_scanned(self):
+        self.scanned_rows = self.rows
+        self.scanned_row_count = len(self.rows)
+
+    def run_collect(self, incremental=False, row_nums=None):
+        """Execute the collect command
+
+        Args:
+            incremental: If True, only process rows with timestamp > last_checked_timestamp
+            row_nums: If given, only process these cached rows
+        """
+        idx_timestamp, idx_sbd, idx_lang, idx_mabai, idx_code = (
+            self.idx_timestamp, self.idx_sbd, self.idx_lang, self.idx_mabai, self.idx_code
+        )
+        last_checked_timestamp = self.last_checked_timestamp
+
+        # Clear old folder before collect subs
+        # if os.path.exists(self.output_dir):
+        #     import shutil
+        #     shutil.rmtree(self.output_dir)
+        # os.makedirs(self.output_dir, exist_ok=True)
+
+        # For collect: process ALL submissions, not just unique combinations
+        scan_start = self.first_row_to_scan(incremental)
+        if incremental:
+            self.log(f"Reading from row {scan_start} to end (incremental mode: timestamp > {last_checked_timestamp})...")
+        else:
+            self.log(f"Reading from row {scan_start} to end...")
+
+        # Single pass: parse and filter each row, mark every valid submission as collected and
+        # resolve the winner per (user, problem) against the winner index so each output file is
+        # written once. Rows are consumed as they come, so in streaming mode only the current
+        # page and the winners are held in memory.
+        batch_updates = []
+        row_hashes = {}  # row_num -> row_hash of the rows to record, in ledger mode
+        ledger = self.ledger
+        row_hash = None
+        winners = {}
+        scanned_count = 0
+        valid_count = 0
+        current_max_timestamp = last_checked_timestamp
+        scan_started = time.perf_counter()
+        fetch_before = self.metrics.phases.get("fetch", 0.0)
+        perf_counter = time.perf_counter
+        parse_time = 0.0
+
+        for row_num, row in self.iter_rows(scan_start, row_nums):
+            scanned_count += 1
+            # Skip empty rows or rows that are too short
+            if not row or len(row) <= max(idx_timestamp, idx_sbd, idx_lang, idx_mabai, idx_code):
+                continue
+
+            try:
+                sbd = row[idx_sbd].strip() if idx_sbd < len(row) else ""
+                timestamp_str = row[idx_timestamp].strip() if idx_timestamp < len(row) else ""
+
+                # Skip if essential fields are empty
+                if not sbd or not timestamp_str:
+                    continue
+
+                # Parse to a UNIX timestamp for comparison (None if unparseable or already collected)
+                parse_started = perf_counter()
+                unix_timestamp = self.parse_timestamp(timestamp_str)
+                parse_time += perf_counter() - parse_started
+                if unix_timestamp is None:
+                    continue
+
+                # Skip if incremental mode and timestamp is not newer
+                if incremental and unix_timestamp <= last_checked_timestamp:
+                    continue
+
+                # In ledger mode processed rows keep their timestamp; the ledger knows them instead
+                if ledger is not None:
+                    row_hash = self.row_hash(row)
+                    if ledger.contains(row_num, row_hash):
+                        continue
+
+                # Track the maximum timestamp seen
+                current_max_timestamp = max(current_max_timestamp, unix_timestamp)
+
+            except (ValueError, IndexError):
+                continue
+
+            # Map password to username if the SBD is a password
+            actual_username = sbd
+            if sbd in self.password_to_username:
+                actual_username = self.password_to_username[sbd]
+            elif sbd not in self.users:
+                continue
+
+            mabai = row[idx_mabai].strip() if idx_mabai < len(row) else ""
+            lang = row[idx_lang].strip() if idx_lang < len(row) else ""
+            code = row[idx_code] if idx_code < len(row) else ""
+            # None means the projected fetch skipped this row's code because it lost to another submission
+            if code is not None:
+                code = code.strip()
+
+            # Make mabai uppercase
+            mabai = mabai.upper()
+
+            # Prevent some stupid errors.
+            if not sbd or not lang or not mabai or code == "":
+                continue
+
+            if "c" in lang.lower():
+                ext = "cpp"
+            elif "py" in lang.lower():
+                ext = "py"
+            else:
+                continue
+
+            valid_count += 1
+            batch_updates.append((row_num, idx_timestamp + 1, unix_timestamp))
+            if ledger is not None:
+                row_hashes[row_num] = row_hash
+
+            # None means a projected fetch already found a better submission for this pair
+            if code is None:
+                continue
+
+            # In row order, --first keeps the earliest timestamp and --last the latest (ties to the later row)
+            key = (actual_username, mabai)
+            is_known = winners[key][0] if key in winners else key in self.winner_index
+            if self.update_winner_index(key, unix_timestamp, row_num):
+                winners[key] = (is_known, (unix_timestamp, row_num, sbd, actual_username, mabai, ext, code))
+
+        self.record_scan_phases(scan_started, fetch_before, parse_time)
+        self.metrics.count("rows_scanned", scanned_count)
+        self.metrics.count("submissions", valid_count)
+        self.metrics.count("winners", len(winners))
+        self.log(f"Found {valid_count} valid submissions to process (order: {self.sub_order})")
+
+        processed_count = 0
+        skipped_count = scanned_count - valid_count
+        sink = self.sink
+        saved = []  # (name, code, ext) of every file now holding a winner, for --precheck
+        files_started = time.perf_counter()
+        for is_known, (unix_timestamp, row_num, sbd, actual_username, mabai, ext, code) in winners.values():
+            filename = f"[{self.file_id}][{actual_username}][{mabai}].{ext}"
+
+            # For --first: keep a file written by an earlier run of another process
+            if self.sub_order == "first" and not is_known and sink.exists(filename):
+                self.log(f"⚠️  File {sink.describe(filename)} already exists (keeping first submission), skipping...")
+                continue
+
+            if sink.write(filename, code):
+                self.log(f"✅ Saved {sink.describe(filename)}")
+                processed_count += 1
+            else:
+                self.log(f"✓ {sink.describe(filename)} unchanged, skipping write")
+            saved.append((sink.describe(filename), code, ext))
+        # Files have to be durable before the rows are marked as collected
+        sink.flush()
+        self.metrics.add_time("files", time.perf_counter() - files_started)
+        self.metrics.count("files_written", processed_count)
+
+        # Write all timestamps back in as few quota-aware requests as possible
+        if batch_updates:
+            with self.metrics.phase("mark"):
+                self.mark_processed(batch_updates, row_hashes)
+
+        # Update last checked timestamp for incremental mode
+        if current_max_timestamp > self.last_checked_timestamp:
+            self.last_checked_timestamp = current_max_timestamp
+            self.log(f"📊 Updated last checked timestamp to: {self.last_checked_timestamp}")
+        self.mark_rows_scanned()
+
+        # The rows are already marked, so a failing check never makes a submission be collected twice
+        if self.prechecker is not None and saved:
+            self.precheck(saved)
+
+        self.log(f"✅ Collect complete. Processed {processed_count} submissions, skipped {skipped_count} rows.")
+
+    def record_scan_phases(self, scan_started, fetch_before, parse_time):
+        """Split a scan's time into timestamp parsing ("parse") and filtering and grouping ("group")"""
+        metrics = self.metrics
+        elapsed = time.perf_counter() - scan_started
+        # Streaming fetches pages during the scan; that time is already reported as fetch
+        fetched = metrics.phases.get("fetch", 0.0) - fetch_before
+        metrics.add_time("parse", parse_time)
+        metrics.add_time("group", max(0.0, elapsed - parse_time - fetched))
+
+    def precheck(self, saved):
+        """Syntax-check the saved files on the pre-check process pool and report the ones the grader should skip"""
+        with self.metrics.phase("precheck"):
+            entries, checked = self.prechecker.check(saved)
+        self.metrics.count("prechecked", checked)
+        statuses = [entry["status"] for _, entry in entries]
+        self.log(f"🔎 Pre-checked {len(entries)} files ({checked} new): {statuses.count('ok')} ok, "
+                 f"{statuses.count('error')} with errors, {statuses.count('wrong_language')} in the wrong language, "
+                 f"{statuses.count('unchecked')} unchecked")
+        for name, entry in entries:
+            if entry["status"] == "error":
+                self.log(f"⚠️ {name} does not compile as {entry['declared']}")
+            elif entry["status"] == "wrong_language":
+                self.log(f"⚠️ {name} is {entry['language']}, not {entry['declared']}")
+
+    def run_cleanup(self, incremental=False, row_nums=None):
+        """Execute the cleanup command
+
+        Args:
+            incremental: If True, only process rows with timestamp > last_checked_timestamp
+            row_nums: If given, only process these cached rows
+        """
+        idx_timestamp, idx_sbd, idx_lang, idx_mabai, idx_code = (
+            self.idx_timestamp, self.idx_sbd, self.idx_lang, self.idx_mabai, self.idx_code
+        )
+        last_checked_timestamp = self.last_checked_timestamp
+
+        # Winning row per (user, problem), resolved against the winner index as rows come in
+        subs = {}
+        ledger = self.ledger
+        row_hash = None
+
+        scan_start = self.first_row_to_scan(incremental)
+        if incremental:
+            self.log(f"Reading from row {scan_start} to end (incremental mode: timestamp > {last_checked_timestamp})...")
+        else:
+            self.log(f"Reading from row {scan_start} to end...")
+
+        processed_count = 0
+        skipped_count = 0
+        current_max_timestamp = last_checked_timestamp
+        scan_started = time.perf_counter()
+        fetch_before = self.metrics.phases.get("fetch", 0.0)
+        perf_counter = time.perf_counter
+        parse_time = 0.0
+
+        for row_num, row in self.iter_rows(scan_start, row_nums):
+            # Skip empty rows or rows that are too short
+            if not row or len(row) <= max(idx_timestamp, idx_sbd, idx_lang, idx_mabai, idx_code):
+                skipped_count += 1
+                continue
+
+            try:
+                sbd = row[idx_sbd].strip() if idx_sbd < len(row) else ""
+                timestamp_str = row[idx_timestamp].strip() if idx_timestamp < len(row) else ""
+
+                # Skip if essential fields are empty
+                if not sbd or not timestamp_str:
+                    skipped_count += 1
+                    continue
+
+                # Parse to a UNIX timestamp for comparison (None if unparseable or already collected)
+                parse_started = perf_counter()
+                unix_timestamp = self.parse_timestamp(timestamp_str)
+                parse_time += perf_counter() - parse_started
+                if unix_timestamp is None:
+                    skipped_count += 1
+                    continue
+
+                # Skip if incremental mode and timestamp is not newer
+                if incremental and unix_timestamp <= last_checked_timestamp:
+                    skipped_count += 1
+                    continue
+
+                # In ledger mode processed rows keep their timestamp; the ledger knows them instead
+                if ledger is not None:
+                    row_hash = self.row_hash(row)
+                    if ledger.contains(row_num, row_hash):
+                        skipped_count += 1
+                        continue
+
+                # Track the maximum timestamp seen
+                current_max_timestamp = max(current_max_timestamp, unix_timestamp)
+
+            except (ValueError, IndexError):
+                skipped_count += 1
+                continue
+
+            # Map password to username if the SBD is a password
+            actual_username = sbd
+            if sbd in self.password_to_username:
+                actual_username = self.password_to_username[sbd]
+            elif sbd not in self.users:
+                skipped_count += 1
+                continue
+
+            mabai = row[idx_mabai].strip().upper() if idx_mabai < len(row) else ""
+            if not mabai:
+                skipped_count += 1
+                continue
+
+            processed_count += 1
+
+            # For each (user, mabai), pick first or last, compared against winners from earlier polls
+            if self.update_winner_index((actual_username, mabai), unix_timestamp, row_num):
+                subs[(actual_username, mabai)] = (unix_timestamp, row_num, sbd, row_hash)
+
+        self.record_scan_phases(scan_started, fetch_before, parse_time)
+        self.metrics.count("rows_scanned", processed_count + skipped_count)
+        self.metrics.count("submissions", processed_count)
+        self.metrics.count("winners", len(subs))
+        self.log(f"Found {len(subs)} unique (user, problem) combinations to process from {processed_count} valid rows (skipped {skipped_count} rows)")
+
+        # Batch updates for Google Sheets
+        batch_updates = []
+        row_hashes = {}
+
+        for unix_ts, row_num, sbd, row_hash in subs.values():
+            batch_updates.append((row_num, idx_timestamp + 1, unix_ts))
+            row_hashes[row_num] = row_hash
+            self.log(f"Marked as collected for SBD {sbd}")
+
+        # Write all timestamps back in as few quota-aware requests as possible
+        if batch_updates:
+            with self.metrics.phase("mark"):
+                self.mark_processed(batch_updates, row_hashes)
+
+        # Update last checked timestamp for incremental mode
+        if current_max_timestamp > self.last_checked_timestamp:
+            self.last_checked_timestamp = current_max_timestamp
+            self.log(f"📊 Updated last checked timestamp to: {self.last_checked_timestamp}")
+        self.mark_rows_scanned()
+
+        self.log(f"✅ Cleanup complete. Processed {len(subs)} unique (user, problem) combinations.")
+
+    def detect_timestamp_format(self, rows):
+        """Settle day-first vs month-first slash dates from rows about to be parsed"""
+        parser = self.timestamp_parser
+        if parser.slash_order is not None:
+            return
+        idx_timestamp = self.idx_timestamp
+        parser.detect(row[idx_timestamp] for row in rows if idx_timestamp < len(row))
+        if parser.misread:
+            self.log(f"⚠️ Timestamps are month-first, but {parser.misread} earlier ambiguous dates were read day-first; "
+                     f"submissions processed before may have been ordered wrongly")
+            parser.misread = 0
+
+    def iter_rows(self, scan_start, row_nums=None):
+        """(row_num, row) pairs from scan_start to the end of the sheet, or just the given cached rows.
+
+        Normally these come from the cached rows. In streaming mode pages of
+        page_size rows are fetched on demand and dropped once consumed. The
+        timestamp column is read first to find where the sheet ends, since
+        the API drops trailing empty rows and a page can come back short in
+        the middle of the sheet.
+        """
+        if row_nums is not None:
+            self.detect_timestamp_format(self.rows[row_num - 1] for row_num in row_nums)
+            yield from ((row_num, self.rows[row_num - 1]) for row_num in row_nums)
+            return
+        if not self.page_size:
+            self.detect_timestamp_format(itertools.islice(self.rows, scan_start - 1, None))
+            yield from enumerate(self.rows[scan_start-1:], start=scan_start)
+            return
+        # Every submission has a timestamp, so rows after its last value can't hold one
+        ts_letter = col_letter(self.idx_timestamp)
+        last_row_num = scan_start + len(self.fetch_range(f"{ts_letter}{scan_start}:{ts_letter}")) - 1
+        for page_start in range(scan_start, last_row_num + 1, self.page_size):
+            page = self.fetch_rows(page_start, min(page_start + self.page_size - 1, last_row_num))
+            self.detect_timestamp_format(page)
+            yield from enumerate(page, start=page_start)
+
+    def run(self, incremental=False, row_nums=None):
+        """Run the configured command once over the cached rows (or only row_nums)"""
+        if self.command == "collect":
+            self.run_collect(incremental=incremental, row_nums=row_nums)
+        elif self.command == "cleanup":
+            self.run_cleanup(incremental=incremental, row_nums=row_nums)
+
+    def reload_users(self):
+        """Pick up roster edits; returns the usernames and passwords added since the last load"""
+        try:
+            added = self.roster.reload()
+        except ValueError as e:
+            self.log(f"⚠️ {e} Keeping the previous roster.")
+            return set()
+        if added:
+            self.log(f"👥 Roster changed, now {len(self.users)} users")
+        return added
+
+    def backfill_users(self, added):
+        """Process the earlier rows of newly added roster entries, which the watermark would skip"""
+        idx_sbd, idx_code = self.idx_sbd, self.idx_code
+        row_nums = [
+            row_num for row_num, row in enumerate(self.rows[self.start_row - 1:], start=self.start_row)
+            if idx_sbd < len(row) and row[idx_sbd].strip() in added
+        ]
+        if not row_nums:
+            return
+        self.log(f"👥 Checking {len(row_nums)} earlier rows of the new roster entries...")
+
+        # The projected fetch skipped code for users it did not know yet
+        missing = [r for r in row_nums if idx_code < len(self.rows[r - 1]) and self.rows[r - 1][idx_code] is None]
+        if missing and self.command == "collect":
+            code_letter = col_letter(idx_code)
+            code_data = self.read([f"{code_letter}{r}" for r in missing])
+            for row_num, values in zip(missing, code_data):
+                self.rows[row_num - 1][idx_code] = values[0][0] if values and values[0] else ""
+                self.state_dirty_rows.add(row_num)
+
+        self.run(incremental=False, row_nums=row_nums)
+
+    def set_header(self, header):
+        """Use the column indices that header maps to"""
+        columns = map_header(header)
+        self.header = header
+        self.idx_timestamp = columns["timestamp"]
+        self.idx_sbd = columns["sbd"]
+        self.idx_lang = columns["lang"]
+        self.idx_mabai = columns["mabai"]
+        self.idx_code = columns["code"]
+
+    def remap_header(self, header):
+        """Follow a header change (a question added, removed or moved) without refetching the sheet.
+
+        Cached rows are rearranged locally to the new column layout, matching
+        columns by their header text; a mapped column whose text changed is
+        assumed to be renamed in place. Columns that cannot be matched become
+        empty; they hold none of the fields we read, and the fingerprint check
+        that follows refetches any block whose timestamps no longer agree with
+        the sheet. If a field now maps to a different
+        column than before, every cached row is scanned again.
+        """
+        old_header = self.header
+        old_columns = map_header(old_header)
+        columns = map_header(header)  # raises if a column we need is gone
+
+        def unique_positions(cells):
+            positions = {}
+            for i, cell in enumerate(cells):
+                positions[cell] = None if cell in positions else i
+            return positions
+
+        old_positions = unique_positions(old_header)
+        new_positions = unique_positions(header)
+        sources = [old_positions.get(cell) if new_positions[cell] is not None else None for cell in header]
+        rescan = False
+        for field, i in columns.items():
+            old_i = old_columns[field]
+            if sources[i] is None and old_i < len(old_header) and old_header[old_i] not in new_positions:
+                sources[i] = old_i
+            rescan = rescan or sources[i] != old_i
+
+        rows = self.rows
+        for n in range(1, len(rows)):
+            row = rows[n]
+            rows[n] = [row[i] if i is not None and i < len(row) else "" for i in sources]
+        rows[0] = list(header)
+        self.set_header(header)
+        self.state_dirty_rows.update(range(1, len(rows) + 1))
+        if rescan:
+            self.scanned_row_count = 0
+        self.log(f"📐 Header changed, remapped columns: timestamp={self.idx_timestamp}, sbd={self.idx_sbd}, "
+                 f"lang={self.idx_lang}, mabai={self.idx_mabai}, code={self.idx_code}"
+                 + (" (column meaning changed, rescanning all rows)" if rescan else ""))
+
+    def fingerprint_columns(self):
+        """Columns compared to notice changed rows: column A (for the row count) and the timestamp.
+
+        Google Forms rewrites the timestamp when a response is edited, so it is
+        enough to notice edits, and keeps each check to two narrow columns.
+        Hand edits to other cells that leave the timestamp alone are not seen.
+        """
+        return sorted({0, self.idx_timestamp} - {self.idx_code})
+
+    def row_fingerprint(self, row, cols):
+        return tuple(row[c] if c < len(row) and row[c] is not None else "" for c in cols)
+
+    def refresh_rows(self):
+        """Bring the cached rows up to date with the sheet.
+
+        Fetches only the fingerprint columns (one narrow batch_get) and compares
+        them block by block against the cache. Blocks that differ are refetched
+        and spliced in, rows appended at the bottom are fetched as a delta
+        (A{n+1}:Z{m}), and deleted rows are dropped from the end of the cache.
+        The header row rides along in the same request; if it changed, the
+        columns are remapped first.
+        """
+        rows = self.rows
+        cached_row_count = len(rows)
+
+        cols = self.fingerprint_columns()
+        data = self.read(["A1:Z1"] + [f"{col_letter(c)}1:{col_letter(c)}" for c in cols])
+        header = data[0][0] if data[0] else []
+        if header != self.header:
+            self.remap_header(header)
+            cols = self.fingerprint_columns()
+            data = self.read([f"{col_letter(c)}1:{col_letter(c)}" for c in cols])
+        else:
+            data = data[1:]
+        idx_timestamp = self.idx_timestamp
+        new_row_count = max((len(values) for values in data), default=0)
+        fresh = [
+            tuple(values[i][0] if i < len(values) and values[i] else "" for values in data)
+            for i in range(new_row_count)
+        ]
+
+        # Adopt the sheet's rendering of timestamps we wrote ourselves, it may differ from the Unix value we sent
+        if idx_timestamp in cols:
+            k = cols.index(idx_timestamp)
+            for row_num in self.written_rows:
+                if row_num <= min(new_row_count, cached_row_count) and idx_timestamp < len(rows[row_num - 1]):
+                    rows[row_num - 1][idx_timestamp] = fresh[row_num - 1][k]
+                    self.state_dirty_rows.add(row_num)
+        self.written_rows.clear()
+
+        # Compare fingerprints block by block, merging neighbouring changed blocks into one range
+        overlap = min(new_row_count, cached_row_count)
+        changed = []  # (start, end) 0-based, end exclusive
+        for block_start in range(0, overlap, FINGERPRINT_BLOCK_ROWS):
+            block_end = min(block_start + FINGERPRINT_BLOCK_ROWS, overlap)
+            if any(self.row_fingerprint(rows[i], cols) != fresh[i] for i in range(block_start, block_end)):
+                if changed and changed[-1][1] == block_start:
+                    changed[-1] = (changed[-1][0], block_end)
+                else:
+                    changed.append((block_start, block_end))
+
+        if new_row_count < cached_row_count:
+            # Rows after a deletion shift up, so they also show up as changed blocks above
+            self.log(f"📥 Detected {cached_row_count - new_row_count} deleted rows")
+            del rows[new_row_count:]
+            self.scanned_row_count = min(self.scanned_row_count, new_row_count)
+
+        for block_start, block_end in changed:
+            self.log(f"📥 Detected changes in rows {block_start + 1}-{block_end}, refetching them...")
+            fetched = self.fetch_rows(block_start + 1, block_end)
+            fetched += [[] for _ in range(block_end - block_start - len(fetched))]
+            rows[block_start:block_end] = fetched
+            self.state_dirty_rows.update(range(block_start + 1, block_end + 1))
+        if changed:
+            # Changed rows have to be scanned again by the next incremental run
+            self.scanned_row_count = min(self.scanned_row_count, changed[0][0])
+
+        if new_row_count > cached_row_count:
+            self.log(f"📥 Detected {new_row_count - cached_row_count} new rows, fetching delta...")
+            # The fingerprint already told where the sheet ends, so --shards needs no column A read to split
+            # the delta (rows added since are found by the next poll)
+            rows.extend(self.fetch_rows(cached_row_count + 1, new_row_count))
+
+        if changed or new_row_count != cached_row_count:
+            self.log(f"📊 Sheet now has {len(rows)} total rows")
+        else:
+            self.log("✓ No changes detected, using incremental mode")
+
+    def sheet_version(self):
+        """Drive revision number of the spreadsheet, or None when it cannot be read
+
+        The version goes up on every change to the file, so an unchanged version
+        means the poll can be skipped after a single metadata request.
+        """
+        if not self.metadata_check or self.session is None:
+            return None
+        self.metrics.count("metadata_requests")
+        try:
+            response = self.session.get(
+                DRIVE_FILES_URL.format(self.sheet.spreadsheet.id),
+                params={"fields": "version", "supportsAllDrives": "true"},
+            )
+            response.raise_for_status()
+            return response.json()["version"]
+        except Exception as e:
+            if error_status(e) in (401, 403, 404):
+                # Drive API not enabled or no metadata scope: stop asking
+                self.log(f"⚠️ Cannot read the spreadsheet revision ({e}), checking the sheet directly from now on")
+                self.metadata_check = False
+            return None
+
+    def poll(self):
+        """Run one watch iteration and return the number of seconds until the next one"""
+        self.iteration += 1
+        if self.iteration > 1:
+            # The first iteration also reports the initial fetch done by open()
+            self.metrics = Metrics()
+        try:
+            with self.profiled():
+                return self.poll_iteration()
+        finally:
+            self.finish_metrics()
+
+    def profiled(self, tag=None):
+        """Profile the block if --profile is on and samples this iteration (or always, with a tag)"""
+        if self.profiler is None or (tag is None and not self.profiler.wants(self.iteration)):
+            return contextlib.nullcontext()
+        name = re.sub(r"[^\w.-]+", "_", self.label or self.contest_id or self.sheet_name)
+        return self.profiler.profile(f"{name}-{tag or f'{self.iteration:04d}'}")
+
+    def finish_metrics(self):
+        """Export the metrics of the iteration that just ended; with --quiet, print its summary line"""
+        name = self.label or self.contest_id or self.sheet_name
+        if self.metrics_exporter is not None:
+            self.metrics_exporter.export(name, self.iteration, self.metrics)
+        if self.quiet and "rows_scanned" in self.metrics.counters:
+            self.print(f"📈 Iteration #{self.iteration}: {self.metrics.summary()}")
+
+    def poll_iteration(self):
+        interval_str = format_interval(self.watch_interval)
+        webhook_poll, self.webhook_poll = self.webhook_poll, False
+        requests_before = (self.read_count, self.write_count)
+        rows_before, watermark_before = len(self.rows), self.last_checked_timestamp
+
+        try:
+            with self.metrics.phase("version_check"):
+                version = self.sheet_version()
+
+            if self.iteration == 1:
+                if self.saved_state:
+                    # Saved rows and watermark stand in for the initial full scan
+                    self.log(f"♻️ Resuming incremental mode from saved state (last checked timestamp: {self.last_checked_timestamp})")
+                else:
+                    # First run - full scan
+                    self.run(incremental=False)
+                    with self.metrics.phase("save_state"):
+                        self.save_state()
+                # known_version stays unset: open() fetched the rows before this revision was read, so a
+                # row added in between is only found by the fingerprint check of the next poll, which
+                # follows right away
+                return 0
+
+            added_users = self.reload_users()
+            # A webhook means a row was just added, even if Drive's revision hasn't caught up yet
+            if not added_users and not webhook_poll and version is not None and version == self.known_version:
+                self.log(f"✓ Spreadsheet unchanged (revision {version}), nothing to do")
+                return self.next_interval(False, requests_before)
+
+            self.log(f"\n{'='*60}")
+            self.log(f"🔄 Watch iteration #{self.iteration} - {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+            self.log(f"{'='*60}\n")
+
+            with self.metrics.phase("detect"):
+                try:
+                    self.refresh_rows()
+                except Exception as e:
+                    self.log(f"⚠️ Error checking for changes: {e}, doing full refresh...")
+                    time.sleep(random.uniform(1, 3))
+                    # The header may be what changed; map it before fetching so the columns match the
+                    # new layout (an unmappable header raises and the poll backs off)
+                    header = self.get_sheet_data(1, 1)
+                    self.set_header(header[0] if header else [])
+                    self.rows = self.fetch_rows()
+                    self.written_rows.clear()
+                    self.scanned_row_count = 0
+
             # Run with incremental mode (only process new timestamps)
-            if command == "collect":
-                run_collect(incremental=True)
-            elif command == "cleanup":
-                run_cleanup(incremental=True)
-            
-            print(f"\n⏳ Waiting {interval_str} until next check...")
-            time.sleep(watch_interval)
-            iteration += 1
+            self.run(incremental=True)
+            if added_users:
+                self.backfill_users(added_users)
+            with self.metrics.phase("save_state"):
+                self.save_state()
+            # Our own write-back bumps the revision too, so the next poll does one fingerprint check
+            self.known_version = version
+
+            active = len(self.rows) > rows_before or self.last_checked_timestamp > watermark_before
+            delay = self.next_interval(active, requests_before)
+            if self.adaptive:
+                self.log(f"\n⏳ Waiting {delay:.1f}s until next check ({self.cadence()})...")
+            else:
+                self.log(f"\n⏳ Waiting {interval_str} until next check...")
+            return delay
+        except Exception as e:
+            self.error_streak += 1
+            delay = min(self.watch_interval * 2 ** (self.error_streak - 1), max(ERROR_BACKOFF_MAX, self.watch_interval))
+            delay = random.uniform(1, 3) + delay
+            self.log(f"\n❌ Error during iteration #{self.iteration}: {e}")
+            self.log(f"⏳ Retrying in {delay:.1f}s with exponential backoff...")
+            return delay
+
+    def next_interval(self, active, requests_before):
+        """Seconds until the next poll after a successful one.
+
+        With --adaptive, new rows snap the interval back to watch_interval and
+        every idle poll stretches it by ADAPTIVE_BACKOFF up to max_interval. The
+        interval never drops below what this contest's share of the read/write
+        quota allows for the requests a poll usually takes, and is jittered.
+        """
+        self.error_streak = 0
+        if not self.adaptive:
+            return self.watch_interval
+
+        reads = self.read_count - requests_before[0]
+        writes = self.write_count - requests_before[1]
+        if self.requests_per_poll is None:
+            self.requests_per_poll = (reads, writes)
+        else:
+            # Smooth over a few polls, a single large refresh should not slow everything down
+            self.requests_per_poll = tuple(0.7 * old + 0.3 * new for old, new in zip(self.requests_per_poll, (reads, writes)))
+
+        if active:
+            self.interval = self.watch_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * ADAPTIVE_BACKOFF)
+
+        quota_floor = 0.0
+        for bucket, per_poll in zip((self.read_bucket, self.write_bucket), self.requests_per_poll):
+            if bucket is not None and per_poll:
+                quota_floor = max(quota_floor, per_poll * 60 / (bucket.capacity * self.quota_share))
+        self.effective_interval = max(self.interval, quota_floor)
+        return self.effective_interval * random.uniform(1 - ADAPTIVE_JITTER, 1 + ADAPTIVE_JITTER)
+
+    def cadence(self):
+        """Current adaptive cadence, for the log"""
+        state = "active" if self.interval <= self.watch_interval else "idle, backing off"
+        if self.effective_interval > self.interval:
+            state += ", limited by quota"
+        reads, writes = self.requests_per_poll or (0, 0)
+        return f"{state}, ~{60 / max(self.effective_interval, 1e-9):.1f} polls/min, ~{reads:.1f} reads and {writes:.1f} writes per poll"
+
+    def wait(self, timeout):
+        """Sleep until the next poll is due, or shortly after a webhook trigger so bursts share one poll"""
+        if self.triggered.wait(timeout):
+            time.sleep(WEBHOOK_DEBOUNCE)
+            self.webhook_poll = True
+            self.triggered.clear()
+
+def start_webhook_listener(address, contests, wakeup):
+    """Serve webhook triggers on [host:]port from a background thread"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        """POST / triggers every contest, POST /<name> only the contest with that name, contest ID or sheet"""
+
+        def do_POST(self):
+            url = urlsplit(self.path)
+            server = self.server
+            # The body is not used, but has to be read before replying
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+            token = self.headers.get("X-Webhook-Token") or parse_qs(url.query).get("token", [None])[0]
+            if server.token and not hmac.compare_digest((token or "").encode("utf-8"), server.token.encode("utf-8")):
+                self.reply(401, "invalid token")
+                return
+
+            target = url.path.strip("/")
+            contests = [
+                contest for contest in server.contests
+                if not target or target in (contest.label, contest.contest_id, contest.sheet_name)
+            ]
+            if not contests:
+                self.reply(404, f"no contest named {target}")
+                return
+
+            for contest in contests:
+                if not contest.triggered.is_set():
+                    contest.log("📨 Webhook received, polling now")
+                contest.triggered.set()
+            server.wakeup.set()
+            self.reply(202, "queued")
+
+        def reply(self, status, message):
+            self.send_response(status)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.end_headers()
+            self.wfile.write(f"{message}\n".encode("utf-8"))
+
+        def log_message(self, format, *args):
+            # Triggers are logged per contest above; skip the default access log on stderr
+            pass
+
+    host, _, port = address.rpartition(":")
+    server = ThreadingHTTPServer((host or "127.0.0.1", int(port)), WebhookHandler)
+    server.daemon_threads = True
+    server.contests = contests
+    server.wakeup = wakeup
+    server.token = os.getenv("WEBHOOK_TOKEN")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"📡 Listening for webhooks on http://{host or '127.0.0.1'}:{server.server_address[1]}/")
+    if not server.token:
+        print("⚠️ WEBHOOK_TOKEN is not set, anyone who can reach the listener can trigger polls")
+    return server
+
+def open_client(pool_size=1):
+    """Authorize one gspread client, sized to serve pool_size sheets concurrently"""
+    import gspread
+    from google.oauth2.service_account import Credentials
+
+    # drive.metadata.readonly only serves the cheap "has anything changed" revision check
+    SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive.metadata.readonly"]
+    creds = Credentials.from_service_account_file(SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+    client = gspread.authorize(creds)
+
+    # requests keeps 10 connections per host by default; concurrent polls need one each
+    session = client_session(client)
+    if session is not None and pool_size > 10:
+        from requests.adapters import HTTPAdapter
+        session.mount("https://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+    return client
+
+def load_contest_config(config_file, defaults):
+    """Build Contest objects from a JSON config listing many contests.
+
+    The file holds a list of entries (or {"contests": [...]}). Each entry needs
+    "spreadsheet_url" and "sheet" and may set "contest_id", "users",
+    "output_dir", "interval", "order", "row", "projected" and "command";
+    anything left out falls back to the command line options in defaults.
+    """
+    with open(config_file, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    entries = config.get("contests", []) if isinstance(config, dict) else config
+    if not entries:
+        raise ValueError(f"No contests listed in {config_file}")
+
+    contests = []
+    for n, entry in enumerate(entries, start=1):
+        options = dict(defaults)
+        options.update(
+            spreadsheet_url=entry.get("spreadsheet_url"),
+            sheet_name=entry.get("sheet"),
+            contest_id=entry.get("contest_id", defaults["contest_id"]),
+            users_file=entry.get("users", defaults["users_file"]),
+            output_dir=entry.get("output_dir", defaults["output_dir"]),
+            sub_order=entry.get("order", defaults["sub_order"]),
+            start_row=int(entry.get("row", defaults["start_row"])),
+            projected_fetch=bool(entry.get("projected", defaults["projected_fetch"])),
+            command=entry.get("command", defaults["command"]),
+        )
+        if "interval" in entry:
+            options["watch_interval"] = parse_time_interval(str(entry["interval"]))
+        if options["command"] not in ["collect", "cleanup"] or options["sub_order"] not in ["first", "last"]:
+            raise ValueError(f"Contest #{n} in {config_file}: command must be collect/cleanup and order first/last")
+        if options["start_row"] < 2:
+            raise ValueError(f"Contest #{n} in {config_file}: row must be >= 2 (row 1 is the header)")
+        options["label"] = entry.get("name") or options["contest_id"] or options["sheet_name"] or f"contest-{n}"
+        contests.append(Contest(**options))
+    return contests
+
+def watch_contests(contests, listen_address=None):
+    """Poll every contest on its own interval, running due polls concurrently on a thread pool.
+
+    With listen_address, a webhook listener also triggers polls ahead of schedule.
+    """
+    for contest in contests:
+        contest.log(f"🔄 Watch mode enabled. Running {contest.command} every {format_interval(contest.watch_interval)}. Press Ctrl+C to stop.")
+    print("🚀 Using incremental mode for better performance")
+
+    for contest in contests:
+        # Contests on one service account split its quota budget
+        contest.quota_share = 1.0 / len(contests)
+
+    wakeup = threading.Event()  # set by the webhook listener
+    if listen_address:
+        start_webhook_listener(listen_address, contests, wakeup)
+
+    if len(contests) == 1:
+        # A single contest polls on the main thread so Ctrl+C stops it immediately
+        contest = contests[0]
+        try:
+            while True:
+                contest.wait(contest.poll())
         except KeyboardInterrupt:
-            print(f"\n\n🛑 Watch mode stopped by user. Total iterations: {iteration}")
+            print(f"\n\n🛑 Watch mode stopped by user. Total iterations: {contest.iteration}")
+            close_prechecks(contests)
+            close_sinks()
             sys.exit(0)
-        except Exception as e:
-            print(f"\n❌ Error during iteration #{iteration}: {e}")
-            print(f"⏳ Retrying in {interval_str} with exponential backoff...")
-            time.sleep(random.uniform(1, 3))
-            time.sleep(watch_interval)
-            iteration += 1
-else:
-    # Single run
-    if command == "collect":
-        run_collect()
-    elif command == "cleanup":
-        run_cleanup()
+
+    # (next poll time, generation, contest index); rescheduling bumps the generation so the old entry is skipped
+    due = [(time.monotonic(), 0, n) for n in range(len(contests))]
+    heapq.heapify(due)
+    generation = [0] * len(contests)
+    triggered = set()  # contests whose webhook-triggered poll is already scheduled
+    running = {}  # future -> contest index
+    pool = ThreadPoolExecutor(max_workers=len(contests))
+    try:
+        while True:
+            now = time.monotonic()
+            wakeup.clear()
+            busy = set(running.values())
+            for n, contest in enumerate(contests):
+                if contest.triggered.is_set() and n not in busy and n not in triggered:
+                    triggered.add(n)
+                    generation[n] += 1
+                    heapq.heappush(due, (now + WEBHOOK_DEBOUNCE, generation[n], n))
+
+            while due and due[0][0] <= now:
+                _, gen, n = heapq.heappop(due)
+                if gen != generation[n]:
+                    continue
+                contests[n].webhook_poll = contests[n].triggered.is_set()
+                contests[n].triggered.clear()
+                triggered.discard(n)
+                running[pool.submit(contests[n].poll)] = n
+
+            timeout = max(0.0, due[0][0] - now) if due else None
+            if not running:
+                wakeup.wait(timeout)
+                continue
+            if listen_address:
+                # Look at new triggers at least every debounce period while polls run
+                timeout = WEBHOOK_DEBOUNCE if timeout is None else min(timeout, WEBHOOK_DEBOUNCE)
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                n = running.pop(future)
+                generation[n] += 1
+                heapq.heappush(due, (time.monotonic() + future.result(), generation[n], n))
+    except KeyboardInterrupt:
+        total = sum(contest.iteration for contest in contests)
+        print(f"\n\n🛑 Watch mode stopped by user. Total iterations: {total}")
+        pool.shutdown(wait=False, cancel_futures=True)
+        close_prechecks(contests)
+        close_sinks()
+        sys.exit(0)
+
+def main(argv):
+    # Usage: python3 main.py <collect|cleanup> [--first|--last] [--row=N] [--watch[=interval]] [--contest-id=ID] [--projected] [--state=FILE] [--fresh] [--config=FILE] [--sheet-file=FILE] [--record=FILE] [--replay=FILE] [--stream[=N]] [--shards=N] [--listen=[HOST:]PORT] [--adaptive[=max]] [--read-quota=N] [--write-quota=N] [--output=DIR|FILE] [--ledger[=FILE]] [--flush-ledger] [--metrics=FILE] [--quiet] [--profile[=DIR]] [--profile-every=N] [--dry-run] [--precheck[=FILE]]
+    if len(argv) < 2 or argv[1] not in ["collect", "cleanup"]:
+        print_usage()
+        sys.exit(1)
+
+    command = argv[1]
+    sub_order = "last"  # default
+    start_row = 2  # default (skip header at row 1)
+    watch_mode = False  # default
+    watch_interval = 5  # default 5 seconds
+    contest_id = None  # default None (will generate random)
+    projected_fetch = False  # default: fetch whole A:Z range
+    state_file = "watch_state.db"  # default watch state database
+    fresh_start = False  # default: resume from saved watch state
+    config_file = None  # default: single contest from .env
+    sheet_file = None  # default: read the Google Sheet
+    record_file = None  # default: no recording
+    replay_file = None  # default: no replay
+    page_size = None  # default: load the whole sheet at once
+    listen_address = None  # default: no webhook listener
+    adaptive = False  # default: fixed watch interval
+    max_interval = ADAPTIVE_MAX_INTERVAL
+    read_quota = READ_QUOTA_PER_MINUTE
+    output_dir = "BaiLam"  # default: one file per submission in BaiLam/
+    ledger_file = None  # default: mark processed rows in the sheet
+    flush_ledger = False
+    metrics_files = []  # JSON lines and/or Prometheus text files for per-iteration metrics
+    quiet = False
+    profile_dir = None  # default: no profiling
+    profile_every = 1
+    dry_run = False
+    precheck_file = None  # default: no pre-checking
+    write_quota = WRITE_QUOTA_PER_MINUTE
+    shards = 1  # default: one request per range
+
+    # Parse optional arguments
+    i = 2
+    while i < len(argv):
+        arg = argv[i]
+
+        if arg == "--first":
+            sub_order = "first"
+        elif arg == "--last":
+            sub_order = "last"
+        elif arg == "--watch":
+            watch_mode = True
+            # Check if next arg is a time interval (not starting with --)
+            if i + 1 < len(argv) and not argv[i + 1].startswith("--"):
+                watch_interval = parse_time_interval(argv[i + 1])
+                i += 1  # skip the interval arg
+            else:
+                watch_interval = 5  # default
+        elif arg.startswith("--watch="):
+            watch_mode = True
+            interval_str = arg.split("=", 1)[1]
+            watch_interval = parse_time_interval(interval_str)
+        elif arg.startswith("--row="):
+            try:
+                start_row = int(arg.split("=")[1])
+                if start_row < 2:
+                    print("ERROR: --row must be >= 2 (row 1 is the header)")
+                    sys.exit(1)
+            except (ValueError, IndexError):
+                print("ERROR: Invalid --row format. Use --row=N where N is a number >= 2")
+                sys.exit(1)
+        elif arg == "--stream" or arg.startswith("--stream="):
+            try:
+                page_size = int(arg.split("=", 1)[1]) if "=" in arg else STREAM_PAGE_ROWS
+                if page_size < 1:
+                    raise ValueError
+            except ValueError:
+                print("ERROR: Invalid --stream format. Use --stream or --stream=N where N is rows per page")
+                sys.exit(1)
+        elif arg == "--adaptive" or arg.startswith("--adaptive="):
+            adaptive = True
+            if "=" in arg:
+                max_interval = parse_time_interval(arg.split("=", 1)[1])
+        elif arg.startswith("--read-quota=") or arg.startswith("--write-quota="):
+            try:
+                quota = int(arg.split("=", 1)[1])
+                if quota < 1:
+                    raise ValueError
+            except ValueError:
+                print(f"ERROR: Invalid {arg.split('=')[0]} format. Use a number of requests per minute >= 1")
+                sys.exit(1)
+            if arg.startswith("--read-quota="):
+                read_quota = quota
+            else:
+                write_quota = quota
+        elif arg == "--ledger" or arg.startswith("--ledger="):
+            ledger_file = arg.split("=", 1)[1].strip() if "=" in arg else "ledger.db"
+            if not ledger_file:
+                print("ERROR: --ledger cannot be empty")
+                sys.exit(1)
+        elif arg == "--flush-ledger":
+            flush_ledger = True
+        elif arg.startswith("--metrics="):
+            metrics_file = arg.split("=", 1)[1].strip()
+            if not metrics_file:
+                print("ERROR: --metrics cannot be empty")
+                sys.exit(1)
+            metrics_files.append(metrics_file)
+        elif arg == "--quiet":
+            quiet = True
+        elif arg == "--profile" or arg.startswith("--profile="):
+            profile_dir = arg.split("=", 1)[1].strip() if "=" in arg else "profiles"
+            if not profile_dir:
+                print("ERROR: --profile cannot be empty")
+                sys.exit(1)
+        elif arg.startswith("--profile-every="):
+            try:
+                profile_every = int(arg.split("=", 1)[1])
+                if profile_every < 1:
+                    raise ValueError
+            except ValueError:
+                print("ERROR: Invalid --profile-every format. Use --profile-every=N where N >= 1")
+                sys.exit(1)
+        elif arg.startswith("--output="):
+            output_dir = arg.split("=", 1)[1].strip()
+            if not output_dir:
+                print("ERROR: --output cannot be empty")
+                sys.exit(1)
+        elif arg.startswith("--listen="):
+            listen_address = arg.split("=", 1)[1].strip()
+            if not re.fullmatch(r"(.*:)?\d+", listen_address):
+                print("ERROR: Invalid --listen format. Use --listen=PORT or --listen=HOST:PORT")
+                sys.exit(1)
+        elif arg.startswith("--shards="):
+            try:
+                shards = int(arg.split("=", 1)[1])
+                if not 1 <= shards <= MAX_SHARDS:
+                    raise ValueError
+            except ValueError:
+                print(f"ERROR: Invalid --shards format. Use --shards=N where N is between 1 and {MAX_SHARDS}")
+                sys.exit(1)
+        elif arg == "--projected":
+            projected_fetch = True
+        elif arg == "--dry-run":
+            dry_run = True
+        elif arg == "--precheck" or arg.startswith("--precheck="):
+            precheck_file = arg.split("=", 1)[1].strip() if "=" in arg else "precheck.json"
+            if not precheck_file:
+                print("ERROR: --precheck cannot be empty")
+                sys.exit(1)
+        elif arg == "--fresh":
+            fresh_start = True
+        elif arg.startswith("--state="):
+            state_file = arg.split("=", 1)[1].strip()
+            if not state_file:
+                print("ERROR: --state cannot be empty")
+                sys.exit(1)
+        elif arg.startswith("--config="):
+            config_file = arg.split("=", 1)[1].strip()
+            if not config_file:
+                print("ERROR: --config cannot be empty")
+                sys.exit(1)
+        elif arg.startswith("--sheet-file="):
+            sheet_file = arg.split("=", 1)[1].strip()
+            if not sheet_file:
+                print("ERROR: --sheet-file cannot be empty")
+                sys.exit(1)
+        elif arg.startswith("--record="):
+            record_file = arg.split("=", 1)[1].strip()
+            if not record_file:
+                print("ERROR: --record cannot be empty")
+                sys.exit(1)
+        elif arg.startswith("--replay="):
+            replay_file = arg.split("=", 1)[1].strip()
+            if not replay_file:
+                print("ERROR: --replay cannot be empty")
+                sys.exit(1)
+        elif arg.startswith("--contest-id="):
+            contest_id = arg.split("=", 1)[1].strip()
+            if not contest_id:
+                print("ERROR: --contest-id cannot be empty")
+                sys.exit(1)
+        else:
+            print("Unknown option: {}".format(arg))
+            print_usage()
+            sys.exit(1)
+
+        i += 1
+
+    defaults = dict(
+        command=command,
+        sub_order=sub_order,
+        start_row=start_row,
+        contest_id=contest_id,
+        users_file="users.txt",
+        output_dir=output_dir,
+        projected_fetch=projected_fetch,
+        watch_interval=watch_interval,
+        state_file=state_file,
+        fresh_start=fresh_start,
+        page_size=page_size,
+        shards=shards,
+        adaptive=adaptive,
+        max_interval=max_interval,
+        ledger_file=ledger_file,
+        quiet=quiet,
+    )
+    if flush_ledger and (not ledger_file or watch_mode or page_size):
+        # Flushing checks every pending row against the cached rows, after the contest is over
+        print("ERROR: --flush-ledger needs --ledger and a single run without --watch or --stream")
+        sys.exit(1)
+    if precheck_file and command != "collect":
+        print("ERROR: --precheck only applies to collect")
+        sys.exit(1)
+    if listen_address and not watch_mode:
+        print("ERROR: --listen needs --watch (the watch interval becomes the fallback poll)")
+        sys.exit(1)
+    if page_size and watch_mode:
+        # Watch mode needs the cached rows to detect changes between polls
+        print("ERROR: --stream cannot be combined with --watch")
+        sys.exit(1)
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        if not dry_run:
+            raise
+        # A dry run can still check everything that doesn't come from .env
+        print("⚠️ python-dotenv is not installed, .env was not read")
+    spreadsheet_url = os.getenv("SPREADSHEET_URL")
+    sheet_name = os.getenv("SHEETNAME")
+    try:
+        replay_backend = ReplayBackend(replay_file) if replay_file else None
+        if config_file:
+            contests = load_contest_config(config_file, defaults)
+        elif sheet_file:
+            # Offline runs don't need the .env sheet settings; a CSV file has a single unnamed sheet
+            contests = [Contest(spreadsheet_url or sheet_file, sheet_name or "Sheet1", **defaults)]
+        elif replay_file:
+            # Neither does a replay: the recording knows which sheet it was made on
+            recorded_sheet = replay_backend.sheet_names[0] if replay_backend.sheet_names else "Sheet1"
+            contests = [Contest(spreadsheet_url or replay_file, sheet_name or recorded_sheet, **defaults)]
+        else:
+            contests = [Contest(spreadsheet_url, sheet_name, **defaults)]
+    except (OSError, ValueError) as e:
+        print(f"❌ ERROR: {e}")
+        sys.exit(1)
+
+    if dry_run:
+        offline = bool(sheet_file or replay_file)
+        problems = []
+        for path in filter(None, [sheet_file, replay_file]):
+            if not os.path.isfile(path):
+                problems.append(f"{path} not found")
+        if not offline and not os.path.isfile(SERVICE_ACCOUNT_FILE):
+            problems.append(f"{SERVICE_ACCOUNT_FILE} not found, cannot authenticate with Google")
+        for contest in contests:
+            contest_problems = contest.check(offline)
+            problems += contest_problems
+            if not contest_problems:
+                output = f", output {contest.output_dir}" if contest.command == "collect" else ""
+                print(f"✅ {contest.label or contest.sheet_name}: {contest.command} {contest.sub_order} submissions, "
+                      f"{len(contest.roster.users)} users{output}")
+        for problem in problems:
+            print(f"❌ ERROR: {problem}")
+        if problems:
+            sys.exit(1)
+        print(f"🧪 Dry run: {len(contests)} contest(s) look good, nothing was fetched or written")
+        return
+    if metrics_files:
+        exporter = MetricsExporter(metrics_files)
+        for contest in contests:
+            contest.metrics_exporter = exporter
+    if profile_dir:
+        try:
+            profiler = Profiler(profile_dir, profile_every)
+        except OSError as e:
+            print(f"❌ ERROR: {e}")
+            sys.exit(1)
+        for contest in contests:
+            contest.profiler = profiler
+    if precheck_file:
+        try:
+            # One pool for every contest, sized to the machine
+            prechecker = Prechecker(precheck_file)
+        except (OSError, ValueError) as e:
+            print(f"❌ ERROR: {e}")
+            sys.exit(1)
+        for contest in contests:
+            contest.prechecker = prechecker
+
+    def open_contest(contest):
+        # The initial full fetch happens here, before the first iteration
+        with contest.profiled("open"):
+            contest.open(backend, watch_mode=watch_mode)
+
+    try:
+        if replay_file:
+            backend = replay_backend
+        elif sheet_file:
+            backend = FileBackend(sheet_file)
+        else:
+            # One authorized client and connection pool shared by every contest
+            backend = GspreadBackend(open_client(pool_size=len(contests)), read_quota=read_quota, write_quota=write_quota)
+        if record_file:
+            backend = RecordingBackend(backend, record_file)
+
+        if len(contests) == 1:
+            open_contest(contests[0])
+        else:
+            with ThreadPoolExecutor(max_workers=len(contests)) as pool:
+                list(pool.map(open_contest, contests))
+    except (OSError, ValueError) as e:
+        print(f"❌ ERROR: {e}")
+        sys.exit(1)
+
+    # Main execution
+    if watch_mode:
+        watch_contests(contests, listen_address)
+    else:
+        def run_once(contest):
+            contest.iteration = 1
+            with contest.profiled():
+                contest.run()
+                if flush_ledger:
+                    contest.flush_ledger()
+            contest.finish_metrics()
+
+        try:
+            if len(contests) == 1:
+                # Single run
+                run_once(contests[0])
+            else:
+                with ThreadPoolExecutor(max_workers=len(contests)) as pool:
+                    list(pool.map(run_once, contests))
+        finally:
+            close_prechecks(contests)
+            close_sinks()
+
+if __name__ == "__main__":
+    # Pre-check workers are started from the packaged binary too
+    import multiprocessing
+    multiprocessing.freeze_support()
+    main(sys.argv)
@@ -22,4 +22,301 @@ print("SBD index:", idx_sbd)
 print("Language index:", idx_lang)
 print("Mã bài index:", idx_mabai)
 print("Code index:", idx_code)
-print("Password index:", idx_password)
\ No newline at end of file
+print("Password index:", idx_password)
+# Behaviour checks for main.py, run offline against local sheet files (FileBackend)
+import contextlib
+import datetime
+import io
+import json
+import os
+import random
+import tempfile
+import time
+
+import main
+
+HEADER = ["Dấu thời gian", "Số báo danh", "Ngôn ngữ", "Mã bài", "Code"]
+
+def make_contest(workdir, rows, **options):
+    """A contest over a JSON sheet file holding rows, opened quietly"""
+    sheet_path = os.path.join(workdir, "sheet.json")
+    with open(sheet_path, "w", encoding="utf-8") as f:
+        json.dump(rows, f, ensure_ascii=False)
+    with open(os.path.join(workdir, "users.txt"), "w", encoding="utf-8") as f:
+        f.write("alice:pa\nbob:pb\n")
+    options.setdefault("output_dir", os.path.join(workdir, "out"))
+    options.setdefault("fresh_start", True)
+    contest = main.Contest(sheet_path, "Sheet1", contest_id="T", users_file=os.path.join(workdir, "users.txt"),
+                           state_file=os.path.join(workdir, "state.db"), **options)
+    with contextlib.redirect_stdout(io.StringIO()):
+        contest.open(main.FileBackend(sheet_path), watch_mode=options.get("watch_interval") is not None)
+    return contest, sheet_path
+
+def rewrite_sheet(sheet_path, rows):
+    with open(sheet_path, "w", encoding="utf-8") as f:
+        json.dump(rows, f, ensure_ascii=False)
+    # FileBackend reloads on an mtime change, which may be too fine-grained to notice otherwise
+    later = time.time() + 5
+    os.utime(sheet_path, (later, later))
+
+def check_shard_reassembly():
+    rng = random.Random(12)
+    rows = [HEADER] + [[f"01/10/2024 10:{i % 60:02d}:00", "alice", "C++", f"P{i}", f"code {i}"] for i in range(1, 1800)]
+    for i in rng.sample(range(1, len(rows)), 40):
+        rows[i] = []  # blank rows inside shards and at shard borders
+    rows[-3:] = [[], [], ["", "", "", "", "only code"]]  # rows with an empty column A at the end
+    with tempfile.TemporaryDirectory() as workdir:
+        plain, _ = make_contest(workdir, rows)
+        sharded, _ = make_contest(workdir, rows, shards=4)
+        with contextlib.redirect_stdout(io.StringIO()):
+            assert sharded.get_sheet_data() == plain.get_sheet_data(), "sharded fetch differs from a single fetch"
+            assert sharded.get_sheet_data(100, 1700) == plain.get_sheet_data(100, 1700), "sharded range fetch differs"
+    print("✅ Sharded fetches reassemble to the same rows")
+
+def check_remap_header():
+    rows = [HEADER] + [[f"01/10/2024 10:0{i}:00", "alice", "C++", f"P{i}", f"code {i}"] for i in range(1, 6)]
+    with tempfile.TemporaryDirectory() as workdir:
+        contest, sheet_path = make_contest(workdir, rows, watch_interval=5)
+        # A question inserted before the code column, and the language question renamed
+        moved = [row[:3] + ["Lớp" if n == 0 else "10A"] + row[3:] for n, row in enumerate(rows)]
+        moved[0][2] = "Ngôn ngữ lập trình"
+        rewrite_sheet(sheet_path, moved)
+        with contextlib.redirect_stdout(io.StringIO()):
+            contest.refresh_rows()
+        assert (contest.idx_lang, contest.idx_mabai, contest.idx_code) == (2, 4, 5), "columns not remapped"
+        columns = [contest.idx_timestamp, contest.idx_sbd, contest.idx_lang, contest.idx_mabai, contest.idx_code]
+        # Only the columns we read are carried over; the new question's answers are never needed
+        assert [[row[c] for c in columns] for row in contest.rows] == [[row[c] for c in columns] for row in moved], \
+            "cached rows don't match the new layout"
+
+        # A required question renamed beyond recognition is an error, not a silent wrong mapping
+        broken = [row[:5] + (["Bài làm"] if n == 0 else row[5:]) for n, row in enumerate(moved)]
+        rewrite_sheet(sheet_path, broken)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                contest.refresh_rows()
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("an unmappable header was accepted")
+    print("✅ Header changes are remapped, unmappable headers are rejected")
+
+def check_timestamp_parser():
+    def strptime_unix(cell, date_format):
+        return int(time.mktime(datetime.datetime.strptime(cell, date_format).timetuple()))
+
+    rng = random.Random(5)
+    moments = [datetime.datetime(2024, 1, 1) + datetime.timedelta(seconds=rng.randrange(400 * 86400)) for _ in range(3000)]
+    for date_format in ["%d/%m/%Y %H:%M:%S", "%m/%d/%Y %H:%M:%S", "%Y-%m-%d %H:%M:%S", "%d-%m-%Y %H:%M:%S"]:
+        cells = [moment.strftime(date_format) for moment in moments]
+        parser = main.TimestampParser()
+        parser.detect(cells)
+        for cell in cells:
+            assert parser.parse(cell) == strptime_unix(cell, date_format), f"{cell} parsed wrong ({date_format})"
+        assert parser.parse(cells[0]) == strptime_unix(cells[0], date_format), "memoized result differs"
+    # Single-digit parts, unparseable cells and collected rows (a Unix integer)
+    parser = main.TimestampParser()
+    assert parser.parse("5/1/2025 7:08:09") == strptime_unix("5/1/2025 7:08:09", "%d/%m/%Y %H:%M:%S")
+    assert parser.parse("31/02/2025 10:00:00") is None
+    assert parser.parse("1727777100") is None
+    assert parser.parse("not a date") is None
+    print("✅ TimestampParser agrees with strptime in every sheet format")
+
+def check_streaming_end():
+    rows = [HEADER,
+            ["01/10/2024 10:00:00", "alice", "C++", "A", "int a;"],
+            ["", "", "", "", ""],
+            ["01/10/2024 10:01:00", "alice", "C++", "B", "int b;"],
+            [],
+            ["01/10/2024 10:02:00", "bob", "Python", "C", "print(1)"]]
+    expected = None
+    for page_size in (None, 1, 2, 3):
+        with tempfile.TemporaryDirectory() as workdir:
+            contest, _ = make_contest(workdir, [list(row) for row in rows], page_size=page_size)
+            with contextlib.redirect_stdout(io.StringIO()):
+                contest.run()
+            files = sorted(os.listdir(os.path.join(workdir, "out")))
+        expected = expected or files
+        assert len(files) == 3 and files == expected, f"--stream={page_size} collected {files}"
+    print("✅ Streaming reads past blank rows to the end of the sheet")
+
+def check_precheck_isolation():
+    with tempfile.TemporaryDirectory() as workdir:
+        secret = os.path.join(workdir, ".env")
+        with open(secret, "w", encoding="utf-8") as f:
+            f.write("SECRET_TOKEN=hunter2\n")
+        cwd = os.getcwd()
+        os.chdir(workdir)
+        try:
+            for include in ['".env"', f'"{secret}"', f"<{secret}>", '"../' + os.path.basename(workdir) + '/.env"', "</dev/zero>"]:
+                ok, message = main.check_syntax(f"#include {include}\nint main() {{}}\n", "cpp")
+                assert ok is not True and "hunter2" not in message, f"#include {include} leaked: {message}"
+            for splice in ["#/**/include", "%:include", "#inc\\\nlude"]:
+                assert main.unsafe_include(f'{splice} "{secret}"\n'), f"{splice} was followed"
+            assert main.unsafe_include("#include <bits/stdc++.h>\n#include \"vector\"\n") is None
+        finally:
+            os.chdir(cwd)
+    print("✅ Pre-checks never follow includes out of the standard headers")
+
+def check_winner_index_restart():
+    rows = [HEADER, ["01/10/2024 10:00:00", "alice", "C++", "A", "int a;"]]
+    with tempfile.TemporaryDirectory() as workdir:
+        contest, sheet_path = make_contest(workdir, rows, command="cleanup", sub_order="first", watch_interval=1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            contest.poll()
+            contest.poll()
+        contest.state_db.close()
+        with open(sheet_path, encoding="utf-8") as f:
+            rows = json.load(f)
+        assert rows[1][0] == "1727776800", f"first submission not marked: {rows[1]}"
+        # A later resubmission arrives while the watcher is down; the restarted one must still know the winner
+        rows.append(["01/10/2024 10:05:00", "alice", "C++", "A", "int b;"])
+        contest, sheet_path = make_contest(workdir, rows, command="cleanup", sub_order="first", watch_interval=1,
+                                           fresh_start=False)
+        assert contest.winner_index == {("alice", "A"): (1727776800, 2)}, f"winner index not restored: {contest.winner_index}"
+        with contextlib.redirect_stdout(io.StringIO()):
+            contest.poll()
+            contest.poll()
+        contest.state_db.close()
+        with open(sheet_path, encoding="utf-8") as f:
+            rows = json.load(f)
+        assert rows[2][0] == "01/10/2024 10:05:00", f"--first resubmission overwritten after a restart: {rows[2]}"
+    print("✅ The winner index survives a watcher restart")
+
+def check_sinks():
+    import tarfile
+    import zipfile
+
+    def stored(path):
+        """name -> latest content, and the number of entries in an archive"""
+        if path.endswith(".zip"):
+            with zipfile.ZipFile(path) as archive:
+                return {name: archive.read(name) for name in archive.namelist()}, len(archive.infolist())
+        with tarfile.open(path) as archive:
+            members = archive.getmembers()
+            return {m.name: archive.extractfile(archive.getmember(m.name)).read() for m in members}, len(members)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        for ext in ("zip", "tar", "tar.gz"):
+            path = os.path.join(workdir, f"out.{ext}")
+            sink = main.ArchiveSink(path)
+            assert sink.write("a.cpp", "int a;") and sink.write("b.py", "print(1)")
+            sink.flush()
+            assert not sink.write("a.cpp", "int a;"), "unchanged content written again"
+            assert sink.write("a.cpp", "int a2;")
+            sink.flush()
+            files, entries = stored(path)
+            assert files == {"a.cpp": b"int a2;", "b.py": b"print(1)"}, f"{ext}: {files}"
+            assert entries == (3 if sink.appendable else 2), f"{ext}: {entries} entries"
+            # Reopening an archive with a resubmission and a non-UTF-8 entry from elsewhere
+            if ext == "tar":
+                with tarfile.open(path, "a") as archive:
+                    info = tarfile.TarInfo("latin1.txt")
+                    info.size = 3
+                    archive.addfile(info, io.BytesIO(b"\xe9t\xe9"))
+            sink = main.ArchiveSink(path)
+            assert sink.exists("a.cpp") and not sink.write("a.cpp", "int a2;"), f"{ext}: reopened sink lost a.cpp"
+            sink.close()
+            files, entries = stored(path)
+            assert files["a.cpp"] == b"int a2;" and entries == len(files), f"{ext}: close left {entries} entries"
+            assert ext != "tar" or files["latin1.txt"] == b"\xe9t\xe9"
+
+        for sink in (main.DirectorySink(os.path.join(workdir, "dir")), main.SqliteSink(os.path.join(workdir, "out.db"))):
+            assert sink.write("a.cpp", "int a;") and not sink.write("a.cpp", "int a;") and sink.write("a.cpp", "int b;")
+            sink.flush()
+            assert sink.exists("a.cpp") and not sink.exists("b.cpp")
+            sink.close()
+    print("✅ Output sinks keep the latest content per file and append instead of rewriting")
+
+def check_write_back_retries():
+    class QuotaError(Exception):
+        def __init__(self, status):
+            super().__init__(f"HTTP {status}")
+            self.response = type("Response", (), {"status_code": status, "headers": {"Retry-After": "0"}})()
+
+    rows = [HEADER, ["01/10/2024 10:00:00", "alice", "C++", "A", "int a;"], ["01/10/2024 10:01:00", "bob", "C++", "A", "int b;"]]
+    for failures, expect_written in (([429, 503], True), ([400], False)):
+        with tempfile.TemporaryDirectory() as workdir:
+            contest, sheet_path = make_contest(workdir, [list(row) for row in rows], label="t")
+            contest.write_bucket = main.TokenBucket(6000)
+            contest.write_bucket.drain()
+            update_cells = contest.sheet.update_cells
+            errors = list(failures)
+
+            def flaky_update_cells(cells, **kwargs):
+                if errors:
+                    raise QuotaError(errors.pop(0))
+                return update_cells(cells, **kwargs)
+
+            contest.sheet.update_cells = flaky_update_cells
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                try:
+                    contest.run()
+                except RuntimeError:
+                    assert not expect_written, f"write-back gave up after {failures}"
+            log = out.getvalue()
+            with open(sheet_path, encoding="utf-8") as f:
+                marked = [row[0].isdigit() for row in json.load(f)[1:]]
+            assert marked == [expect_written] * 2, f"after {failures}: rows marked {marked}\n{log}"
+            assert "[t] ⚠️ Write quota budget used up" in log, f"quota wait not logged through the contest:\n{log}"
+            assert log.count("[t] ⚠️ Write failed") == (len(failures) if expect_written else 0), log
+    print("✅ Write-back retries 429/5xx, gives up on other errors and logs quota waits")
+
+def check_ledger():
+    rows = [HEADER, ["01/10/2024 10:00:00", "alice", "C++", "A", "int a;"], ["01/10/2024 10:01:00", "bob", "C++", "A", "int b;"]]
+    with tempfile.TemporaryDirectory() as workdir:
+        ledger_file = os.path.join(workdir, "ledger.db")
+        contest, sheet_path = make_contest(workdir, [list(row) for row in rows], ledger_file=ledger_file)
+        with contextlib.redirect_stdout(io.StringIO()):
+            contest.run()
+        with open(sheet_path, encoding="utf-8") as f:
+            assert json.load(f) == rows, "ledger mode wrote to the sheet"
+        assert len(os.listdir(os.path.join(workdir, "out"))) == 2
+
+        # A second run knows both rows from the ledger; bob's row deleted and replaced is a new submission
+        rows[2] = ["01/10/2024 10:02:00", "bob", "C++", "B", "int c;"]
+        contest, sheet_path = make_contest(workdir, [list(row) for row in rows], ledger_file=ledger_file)
+        with contextlib.redirect_stdout(io.StringIO()):
+            contest.run()
+        assert contest.metrics.counters.get("submissions") == 1, contest.metrics.counters
+        assert contest.ledger.contains(3, contest.row_hash(rows[2]))
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            contest.flush_ledger()
+        with open(sheet_path, encoding="utf-8") as f:
+            marked = [row[0] for row in json.load(f)[1:]]
+        assert marked == ["1727776800", "1727776920"], f"ledger flush wrote {marked}"
+        assert contest.ledger.pending() == []
+    print("✅ The ledger remembers processed rows and writes them back on --flush-ledger")
+
+def check_roster_backfill():
+    rows = [HEADER, ["01/10/2024 10:00:00", "alice", "C++", "A", "int a;"], ["01/10/2024 10:01:00", "carol", "C++", "A", "int c;"]]
+    with tempfile.TemporaryDirectory() as workdir:
+        contest, sheet_path = make_contest(workdir, rows, watch_interval=1)
+        with contextlib.redirect_stdout(io.StringIO()):
+            contest.poll()
+            contest.poll()
+        assert sorted(os.listdir(os.path.join(workdir, "out"))) == ["[T][alice][A].cpp"]
+        # carol joins the roster after her submission was already passed by the watermark
+        users_file = os.path.join(workdir, "users.txt")
+        with open(users_file, "a", encoding="utf-8") as f:
+            f.write("carol:pc\n")
+        later = time.time() + 5
+        os.utime(users_file, (later, later))
+        with contextlib.redirect_stdout(io.StringIO()):
+            contest.poll()
+        contest.state_db.close()
+        assert sorted(os.listdir(os.path.join(workdir, "out"))) == ["[T][alice][A].cpp", "[T][carol][A].cpp"]
+    print("✅ Users added to the roster mid-contest get their earlier submissions collected")
+
+check_shard_reassembly()
+check_remap_header()
+check_timestamp_parser()
+check_streaming_end()
+check_precheck_isolation()
+check_winner_index_restart()
+check_sinks()
+check_write_back_retries()
+check_ledger()
+check_roster_backfill()